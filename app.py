@@ -1,74 +1,75 @@
 import os
+import io
+import copy
 import json
+import atexit
+import hmac
+import base64
+import hashlib
 import logging
-from datetime import datetime
-from flask import Flask, request, abort, redirect, url_for, send_file, after_this_request, jsonify
+import threading
+import time
+import requests
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, abort, redirect, url_for, send_file, after_this_request, jsonify, stream_with_context
 from linebot.v3.messaging import (
-    MessagingApi, Configuration, ApiClient, PushMessageRequest, TextMessage, TemplateMessage, ButtonsTemplate, PostbackAction, QuickReply, QuickReplyItem, MessageAction, ApiException, ErrorResponse, FlexMessage, URIAction
+    MessagingApi, Configuration, ApiClient, PushMessageRequest, ReplyMessageRequest, TextMessage, TemplateMessage, ButtonsTemplate, PostbackAction, QuickReply, QuickReplyItem, MessageAction, ApiException, ErrorResponse, FlexMessage, URIAction
 )
-from linebot.v3.webhooks.models import MessageEvent, PostbackEvent
-from linebot.v3.webhook import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks.models import Event
 from dotenv import load_dotenv
-import traceback
-import tempfile
 import re
 
-from services.session_manager import SessionManager
-from services.google_sheets_service import GoogleSheetsService
+from services.session_manager import get_session_manager
+from services.google_sheets_service import GoogleSheetsService, get_authorized_session, invalidate_sheet_gids
 from services.document_generator import DocumentGenerator
 from services.auth_service import AuthService
 from services.pdf_generator import PDFGenerator
 from services.restriction_checker import safe_check_restriction
+from services.circuit_breaker import CircuitBreaker
 
 # 環境変数の読み込み
 load_dotenv()
 
-# Google OAuth認証情報の設定
-# 環境変数からJSON文字列を取得してファイルとして保存
-client_secrets_env = os.getenv('GOOGLE_CLIENT_SECRETS_JSON')
-if client_secrets_env:
-    try:
-        # JSON文字列をファイルとして保存
-        with open('client_secrets.json', 'w') as f:
-            f.write(client_secrets_env)
-        print("[DEBUG] client_secrets.json created from environment variable")
-    except Exception as e:
-        print(f"[ERROR] Failed to create client_secrets.json: {e}")
+# ログ設定（デバッグログはLOG_LEVEL=DEBUGの時のみ出力）
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+# Google OAuth認証情報（GOOGLE_CLIENT_SECRETS_JSON）はAuthServiceがメモリ上で読み込む
 
 app = Flask(__name__)
 
 # データベーステーブルの初期化
-print("[DEBUG] Initializing database tables...")
+logger.debug("Initializing database tables...")
 try:
-    from services.session_manager import SessionManager
-    session_manager = SessionManager()
-    print("[DEBUG] Database tables initialized successfully")
+    session_manager = get_session_manager()
+    logger.debug("Database tables initialized successfully")
 
     # テーブル作成を明示的に実行
-    print("[DEBUG] Forcing database table creation...")
+    logger.debug("Forcing database table creation...")
     session_manager._init_postgres_db() if session_manager.use_postgres else session_manager._init_sqlite_db()
 
     # 自動マイグレーション実行
-    print("[DEBUG] Running auto-migration...")
+    logger.debug("Running auto-migration...")
     try:
         from auto_migrate import check_and_migrate
         check_and_migrate()
-        print("[DEBUG] Auto-migration completed")
+        logger.debug("Auto-migration completed")
     except Exception as migrate_error:
-        print(f"[WARNING] Auto-migration failed (non-critical): {migrate_error}")
-        traceback.print_exc()
-    print("[DEBUG] Database table creation completed")
+        logger.warning("Auto-migration failed (non-critical): %s", migrate_error, exc_info=True)
+    logger.debug("Database table creation completed")
     
     # データベース接続テスト
-    print("[DEBUG] Testing database connection...")
+    logger.debug("Testing database connection...")
     if session_manager.use_postgres:
         import psycopg2
         conn = psycopg2.connect(session_manager.db_url)
         cursor = conn.cursor()
         cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
         tables = cursor.fetchall()
-        print(f"[DEBUG] Existing tables: {[table[0] for table in tables]}")
+        logger.debug("Existing tables: %s", [table[0] for table in tables])
         conn.close()
     else:
         import sqlite3
@@ -76,14 +77,12 @@ try:
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         tables = cursor.fetchall()
-        print(f"[DEBUG] Existing tables: {[table[0] for table in tables]}")
+        logger.debug("Existing tables: %s", [table[0] for table in tables])
         conn.close()
-    print("[DEBUG] Database connection test completed")
+    logger.debug("Database connection test completed")
     
 except Exception as e:
-    print(f"[ERROR] Failed to initialize database tables: {e}")
-    import traceback
-    traceback.print_exc()
+    logger.exception("Failed to initialize database tables: %s", e)
 
 # LINE Bot設定
 line_channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
@@ -91,26 +90,278 @@ line_channel_secret = os.getenv('LINE_CHANNEL_SECRET')
 
 # 環境変数が設定されていない場合のエラーハンドリング
 if not line_channel_access_token or not line_channel_secret:
-    print("ERROR: LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET must be set")
-    print("Please set these environment variables in Railway dashboard")
+    logger.error("LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET must be set")
+    logger.error("Please set these environment variables in Railway dashboard")
     exit(1)
 
 configuration = Configuration(access_token=line_channel_access_token)
-handler = WebhookHandler(line_channel_secret)
+# Webhook処理ワーカーと書類生成ワーカーが同時にLINE APIを呼んでもkeep-alive接続を使い回せるようプールを広げる
+configuration.connection_pool_maxsize = int(os.getenv('LINE_CONNECTION_POOL_SIZE', '20'))
+line_channel_secret_bytes = line_channel_secret.encode('utf-8')
+
+# MessagingApiはプロセス全体で1つを共有する（コネクションプールとTLSセッションを再利用）
+api_client = ApiClient(configuration)
+
+def _is_line_server_error(e):
+    """LINE側の障害（5xx・接続エラー）ならTrue"""
+    return not isinstance(e, ApiException) or e.status is None or e.status >= 500
+
+# LINE APIが障害中（5xx・429・接続エラーが連続）の間は送信を即座に打ち切り、ワーカーがタイムアウト待ちで詰まらないようにする。
+# Push APIは月間の送信上限に達すると429を返し続けるため、Replyとはブレーカーを分け、Push側では429を障害に数えない
+# （上限到達で無料のReply APIまで止めないように）
+line_reply_breaker = CircuitBreaker(
+    'LINE Messaging API (reply)',
+    fail_max=5,
+    reset_timeout=30,
+    is_failure=lambda e: _is_line_server_error(e) or e.status == 429
+)
+line_push_breaker = CircuitBreaker(
+    'LINE Messaging API (push)',
+    fail_max=5,
+    reset_timeout=30,
+    is_failure=_is_line_server_error
+)
+
+class GuardedMessagingApi(MessagingApi):
+    """送信系APIをサーキットブレーカー経由で呼び出すMessagingApi"""
+
+    def push_message(self, *args, **kwargs):
+        return line_push_breaker.call(super().push_message, *args, **kwargs)
 
-# MessagingApiの初期化はwith ApiClientで行う
-with ApiClient(configuration) as api_client:
-    line_bot_api = MessagingApi(api_client)
+    def reply_message(self, *args, **kwargs):
+        return line_reply_breaker.call(super().reply_message, *args, **kwargs)
 
-# サービスの初期化
+line_bot_api = GuardedMessagingApi(api_client)
+# プロセス終了時にコネクションプールを閉じる
+atexit.register(api_client.close)
+
+# 処理中のWebhookイベントの送信先とreply_token（dispatch_webhook_eventがスレッドごとに設定する）
+_event_context = threading.local()
+
+def current_reply_token(user_id):
+    """処理中のイベントがuser_id宛てならそのReplyTokenを返す"""
+    current = getattr(_event_context, 'reply_token', None)
+    if current and current[0] == user_id:
+        return current[1]
+    return None
+
+def send_messages(user_id, messages, context):
+    """処理中のイベントのreply_tokenが使えればReply API、無ければPush APIで送信（失敗はログに残して処理は継続する）"""
+    reply_token = current_reply_token(user_id)
+    try:
+        reply_or_push(user_id, reply_token.take() if reply_token else None, messages)
+    except Exception as e:
+        logger.error("%s: メッセージ送信時に例外発生: %s", context, e)
+
+def send_text(user_id, text, context):
+    """テキスト1通をsend_messagesで送信する"""
+    send_messages(user_id, [TextMessage(text=text)], context)
+
+# ユーザー入力のキーワード（表記ゆれはここに追加する）
+CANCEL_WORDS = frozenset({"キャンセル"})
+YES_WORDS = frozenset({"はい"})
+FIX_WORDS = frozenset({"修正する"})
+DONE_WORDS = frozenset({"完了"})
+
+# 複数箇所で送る定型メッセージ
+MSG_AUTH_URL_FAILED = "❌ Google認証URLの生成に失敗しました。"
+MSG_ITEMS_FIX = "品目の修正を行います。続けて品目を入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000\n\n完了したら「完了」と入力してください。"
+MSG_NO_ITEMS = "品目が入力されていません。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000"
+MSG_EDIT_COMPANY_START = "会社情報の編集を開始します。\n\n会社名を教えてください。"
+MSG_ASK_DUE_DATE = "✅ 品目の入力が完了しました。\n\n次に支払い期日を入力してください。\n形式：YYYY-MM-DD\n例：2024-01-31"
+MSG_GOOGLE_AUTH_DONE = "✅ Google認証が完了しました！\n\n次に会社情報を登録しましょう。\n会社名（法人・屋号含む）を教えてください。"
+MSG_REGISTRATION_DONE = "✅ 会社情報の登録が完了しました！"
+MSG_ITEM_FORMAT_INVALID = "形式が正しくありません。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000"
+MSG_ITEM_NOT_NUMBER = "数量と単価は数字で入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000"
+
+# 固定文言のメッセージ一覧は起動時に1度だけ組み立てて使い回す（送信側で書き換えないこと）
+MSGS_AUTH_URL_FAILED = [TextMessage(text=MSG_AUTH_URL_FAILED)]
+MSGS_ITEMS_FIX = [TextMessage(text=MSG_ITEMS_FIX)]
+MSGS_NO_ITEMS = [TextMessage(text=MSG_NO_ITEMS)]
+MSGS_EDIT_COMPANY_START = [TextMessage(text=MSG_EDIT_COMPANY_START)]
+MSGS_ASK_DUE_DATE = [TextMessage(text=MSG_ASK_DUE_DATE)]
+MSGS_GOOGLE_AUTH_DONE = [TextMessage(text=MSG_GOOGLE_AUTH_DONE)]
+MSGS_ITEM_FORMAT_INVALID = [TextMessage(text=MSG_ITEM_FORMAT_INVALID)]
+MSGS_ITEM_NOT_NUMBER = [TextMessage(text=MSG_ITEM_NOT_NUMBER)]
+
+# 最終確認メッセージの先頭と末尾
+SUMMARY_HEADER = "==========\n【最終確認】\n------------------------------\n"
+SUMMARY_CONFIRM_PROMPT = "この内容で書類を生成してよろしいですか？\n（「はい」または「修正する」と入力してください）"
+
+# 支払い期日（strptime('%Y-%m-%d')と同じく月日は1桁も許容。fullmatchで使う）
+DUE_DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+# 品目入力の正規化用（normalize_item_input）
+ITEM_INPUT_TRANSLATION = str.maketrans('０１２３４５６７８９　、', '0123456789 ,')
+ITEM_SEPARATOR_PATTERN = re.compile(r'[\s,]+')
+
+# 品目入力（normalize_item_input後の「品目名,数量,単価」）
+ITEM_LINE_PATTERN = re.compile(r'^([^,]+),([^,]+),([^,]+)$')
+
+# 「次の候補」Postbackの接頭辞を除いた部分（「書類種別_ページ番号」）
+NEXT_PAGE_ARG_PATTERN = re.compile(r'^([^_]+)_(\d+)$')
+
+# PDFを中継する際のチャンクサイズ
+PDF_STREAM_CHUNK_SIZE = 64 * 1024
+# PDFエクスポートのタイムアウト（接続, 読み取り）秒
+PDF_EXPORT_TIMEOUT = (10, 60)
+
+# 編集済みシートPDFのキャッシュ（(user_id, spreadsheet_id, 最終更新日時) -> (生成時刻, PDFバイト列)）
+# LINEのリンクプレビューや再タップで同じPDFが続けて要求されるため、シートが更新されていなければ再生成しない
+EDITED_SHEETS_PDF_CACHE_TTL = 120
+EDITED_SHEETS_PDF_CACHE_MAX_ENTRIES = 32
+_edited_sheets_pdf_cache = OrderedDict()
+_edited_sheets_pdf_cache_lock = threading.Lock()
+
+# LINE QuickReplyの制限（項目数は最大13、ラベルは最大20文字）
+QUICK_REPLY_MAX_ITEMS = 13
+QUICK_REPLY_LABEL_MAX_LENGTH = 20
+# シート一覧1ページあたりの件数（「次の候補」「新規作成」を足してもQUICK_REPLY_MAX_ITEMS以内に収める）
+SHEET_LIST_PAGE_SIZE = 10
+assert SHEET_LIST_PAGE_SIZE + 2 <= QUICK_REPLY_MAX_ITEMS
+
+# 固定のメニューは起動時に一度だけ組み立てて使い回す（生成後は変更しないこと）
+MAIN_MENU_ACTIONS = [
+    PostbackAction(label='📄 見積書を作る', data='create_estimate'),
+    PostbackAction(label='📋 請求書を作る', data='create_invoice'),
+    PostbackAction(label='⚙️ 会社情報を編集', data='edit_company_info')
+]
+
+MAIN_MENU_TEMPLATE = TemplateMessage(
+    altText='メインメニュー',
+    template=ButtonsTemplate(
+        title='✅ 登録完了',
+        text='何をお手伝いしますか？',
+        actions=MAIN_MENU_ACTIONS
+    )
+)
+
+LOGIN_MENU_TEMPLATE = TemplateMessage(
+    altText='メインメニュー',
+    template=ButtonsTemplate(
+        title='✅ ログイン完了',
+        text='何をお手伝いしますか？',
+        actions=MAIN_MENU_ACTIONS
+    )
+)
+
+# 利用制限中のユーザーへの案内（handle_message / handle_postback 共通）
+RESTRICTION_TEMPLATE = TemplateMessage(
+    alt_text="AI経理秘書の利用制限",
+    template=ButtonsTemplate(
+        title="AI経理秘書の利用制限",
+        text="AI経理秘書は解約されています。公式LINEで再登録してください。",
+        actions=[
+            URIAction(
+                label="AIコレクションズ公式LINE",
+                uri="https://lin.ee/eyYpOKq"
+            ),
+            URIAction(
+                label="サービス詳細",
+                uri="https://lp-production-9e2c.up.railway.app/"
+            )
+        ]
+    )
+)
+
+def send_restriction_template(user_id):
+    """利用制限の案内を送信する（送信失敗はsend_messages内でログに残す）"""
+    send_messages(user_id, [RESTRICTION_TEMPLATE], 'restriction')
+
+def _build_document_creation_menu(doc_type):
+    """書類作成方法の選択メニューを組み立てる"""
+    doc_name = "見積書" if doc_type == 'estimate' else "請求書"
+    return TemplateMessage(
+        altText=f'{doc_name}作成方法選択',
+        template=ButtonsTemplate(
+            title=f'📄 {doc_name}の作成',
+            text='どの方法で作成しますか？',
+            actions=[
+                PostbackAction(label='🆕 新規シートを作成', data=f'new_sheet_{doc_type}'),
+                PostbackAction(label='既存シート', data='existing_sheet'),
+                PostbackAction(label='❌ キャンセル', data='cancel_creation')
+            ]
+        )
+    )
+
+DOCUMENT_CREATION_MENU_TEMPLATES = {
+    'estimate': _build_document_creation_menu('estimate'),
+    'invoice': _build_document_creation_menu('invoice'),
+}
+
+def _build_new_sheet_quick_reply_item(doc_type):
+    """シート一覧の末尾に付ける「新規作成」ボタンを組み立てる"""
+    return QuickReplyItem(
+        action=PostbackAction(
+            label='🆕 新規作成',
+            data=f'new_sheet_{doc_type}'
+        )
+    )
+
+NEW_SHEET_QUICK_REPLY_ITEMS = {
+    'estimate': _build_new_sheet_quick_reply_item('estimate'),
+    'invoice': _build_new_sheet_quick_reply_item('invoice'),
+}
+
+# サービスの初期化（Webhookのほぼ全経路で使うものだけ起動時に生成する）
 google_sheets_service = GoogleSheetsService()
-document_generator = DocumentGenerator()
 auth_service = AuthService()
-pdf_generator = PDFGenerator()
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# 書類生成・PDF出力でしか使わないサービスは初回利用時に生成する
+_document_generator = None
+_pdf_generator = None
+_lazy_service_lock = threading.Lock()
+
+def get_pdf_generator():
+    """PDFGeneratorを取得（フォント登録やスタイル準備は初回呼び出し時のみ）"""
+    global _pdf_generator
+    if _pdf_generator is None:
+        with _lazy_service_lock:
+            if _pdf_generator is None:
+                _pdf_generator = PDFGenerator()
+    return _pdf_generator
+
+def get_document_generator():
+    """DocumentGeneratorを取得（認証・シート・PDFのサービスはアプリ側のものを共有する）
+
+    GoogleSheetsServiceはAPIクライアントを認証情報ごとに持つため、ユーザー間で共有しても
+    他ユーザーの認証情報で呼び出されることはない
+    """
+    global _document_generator
+    if _document_generator is None:
+        pdf_generator = get_pdf_generator()
+        with _lazy_service_lock:
+            if _document_generator is None:
+                _document_generator = DocumentGenerator(
+                    auth_service=auth_service,
+                    sheets_service=google_sheets_service,
+                    pdf_generator=pdf_generator
+                )
+    return _document_generator
+
+# 書類生成はGoogle API呼び出しを含み数秒かかるため、Webhookのワーカーを塞がないようバックグラウンドで実行する
+document_executor = ThreadPoolExecutor(max_workers=int(os.getenv('DOCUMENT_WORKERS', '4')))
+
+# 書類生成がこの秒数以内に終わらない場合のみ進行中メッセージを送る
+DOCUMENT_PROGRESS_NOTICE_DELAY = 3.0
+# reply_tokenの有効期限（LINEの仕様ではイベント発生から約1分）に余裕を持たせた秒数
+REPLY_TOKEN_TTL = 55
+# Webhookのイベント処理はLINEへの応答（200）と切り離してバックグラウンドで行う
+webhook_executor = ThreadPoolExecutor(max_workers=int(os.getenv('WEBHOOK_WORKERS', '16')))
+atexit.register(webhook_executor.shutdown, wait=True)
+# 同じユーザーのイベントは受信順に1件ずつ処理する（ユーザーID -> 未処理イベントのキュー）。
+# キューがある間はそのユーザーのワーカーが1つだけ動いているので、順序が入れ替わらず、セッションの読み書きも競合しない
+_user_event_queues = {}
+_user_event_queues_lock = threading.Lock()
+# 同じwebhookEventIdの再送を無視する期間（秒）
+WEBHOOK_EVENT_DEDUP_TTL = 60
+_recent_webhook_events = OrderedDict()
+_recent_webhook_events_lock = threading.Lock()
+# 書類生成中のユーザー（連打や再送で同じユーザーの生成が重複しないようにする）
+_generating_users = set()
+_generating_users_lock = threading.Lock()
+# PDFダウンロードリンクに使う公開URL
+SERVER_URL = os.getenv("SERVER_URL", "http://192.168.0.207:5001")
 
 @app.route("/")
 def index():
@@ -151,68 +402,113 @@ def index():
 @app.route("/callback", methods=['POST'])
 def callback():
     """LINE Webhookからのコールバック処理"""
-    print("[DEBUG] callback: 関数開始")
-    try:
-        print("[DEBUG] callback: signature取得前")
-        signature = request.headers.get('X-Line-Signature')
-        print(f"[DEBUG] callback: signature取得後: {signature}")
-    except Exception as e:
-        print(f"[ERROR] callback: signature取得で例外: {e}")
-        import traceback
-        traceback.print_exc()
+    signature = request.headers.get('X-Line-Signature', '')
+    if not signature:
+        # 署名ヘッダが無いリクエストは本文を読まずに拒否する
+        logger.warning("Missing X-Line-Signature header")
         abort(400)
-    
-    try:
-        print("[DEBUG] callback: body取得前")
-        body = request.get_data(as_text=True)
-        print(f"[DEBUG] callback: body取得後: {body[:100]}...")  # 最初の100文字のみ表示
-    except Exception as e:
-        print(f"[ERROR] callback: body取得で例外: {e}")
-        import traceback
-        traceback.print_exc()
+    # 生のバイト列のまま署名検証とJSON解析に渡し、文字列へのデコードはデバッグ時のみ行う
+    body = request.get_data()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("callback: body length=%s, preview=%s", len(body), body[:200].decode('utf-8', 'replace'))
+
+    # 署名検証（生のバイト列から直接HMACを計算し、WebhookHandlerでの再パースを避ける）
+    if not verify_line_signature(body, signature):
+        logger.warning("InvalidSignatureError!")
         abort(400)
-    
-    print("=== LINE CALLBACK ===")
-    print("Signature:", signature)
-    print("Body:", body)
-    print(f"[DEBUG] callback: body length={len(body)}")
-    print(f"[DEBUG] callback: body preview={body[:200]}...")
-    
+
     try:
-        print("[DEBUG] callback: handler.handle呼び出し前")
-        handler.handle(body, signature)
-        print("[DEBUG] callback: handler.handle呼び出し後")
-    except InvalidSignatureError:
-        print("InvalidSignatureError!")
-        import traceback
-        traceback.print_exc()
-        abort(400)
-    except Exception as e:
-        print("Exception in handler.handle:", e)
-        import traceback
-        traceback.print_exc()
+        events = json.loads(body).get('events', [])
+    except ValueError as e:
+        logger.warning("Webhook body parse error: %s", e)
         abort(400)
-    
-    print("[DEBUG] callback: OK返却前")
+
+    # LINEへはすぐに200を返し、メッセージ送信などは別スレッドで行う
+    enqueue_webhook_events(events)
     return 'OK'
 
+def enqueue_webhook_events(events):
+    """Webhookで受け取ったイベントをユーザーごとのキューに積み、処理中でなければwebhook_executorで処理を始める"""
+    for event_dict in events:
+        user_id = (event_dict.get('source') or {}).get('userId') or ''
+        with _user_event_queues_lock:
+            queue = _user_event_queues.get(user_id)
+            if queue is not None:
+                # 処理中のワーカーが続けて処理する
+                queue.append(event_dict)
+                continue
+            _user_event_queues[user_id] = deque([event_dict])
+        webhook_executor.submit(drain_user_events, user_id)
+
+def drain_user_events(user_id):
+    """ユーザーのキューが空になるまでイベントを受信順に処理する（webhook_executor上で実行）"""
+    while True:
+        with _user_event_queues_lock:
+            queue = _user_event_queues[user_id]
+            if not queue:
+                del _user_event_queues[user_id]
+                return
+            event_dict = queue.popleft()
+        dispatch_webhook_event(user_id, event_dict)
+
+def dispatch_webhook_event(user_id, event_dict):
+    """Webhookイベントを1件処理する"""
+    event_handler = WEBHOOK_EVENT_HANDLERS.get(event_dict.get('type'))
+    if not event_handler or is_duplicate_webhook_event(event_dict.get('webhookEventId')):
+        return
+    try:
+        # 1イベントの処理中はセッションをDBから1回だけ読む
+        with session_manager.request_scope():
+            event = Event.from_dict(event_dict)
+            _event_context.reply_token = (user_id, ReplyToken(event))
+            try:
+                event_handler(event)
+            finally:
+                _event_context.reply_token = None
+    except Exception as e:
+        # 1件の失敗で同じユーザーの後続のイベントを落とさない
+        logger.exception("Exception in webhook dispatch: %s", e)
+
+def is_duplicate_webhook_event(webhook_event_id):
+    """直近に処理したwebhookEventIdならTrue（LINEの再送を二重に処理しない）"""
+    if not webhook_event_id:
+        return False
+    now = time.monotonic()
+    with _recent_webhook_events_lock:
+        # 古いものから順に期限切れを捨てる
+        while _recent_webhook_events:
+            seen_at = next(iter(_recent_webhook_events.values()))
+            if now - seen_at < WEBHOOK_EVENT_DEDUP_TTL:
+                break
+            _recent_webhook_events.popitem(last=False)
+        if webhook_event_id in _recent_webhook_events:
+            logger.info("再送されたイベントをスキップ: webhookEventId=%s", webhook_event_id)
+            return True
+        _recent_webhook_events[webhook_event_id] = now
+    return False
+
+def verify_line_signature(body, signature):
+    """X-Line-Signatureを検証"""
+    mac = hmac.new(line_channel_secret_bytes, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(mac), signature.encode('utf-8'))
+
 @app.route("/auth/callback")
 def auth_callback():
     """Google OAuth認証コールバック"""
     try:
         code = request.args.get('code')
         state = request.args.get('state')  # ユーザーID
-        print(f"[DEBUG] auth_callback: state={state}, code={code[:20] if code else 'None'}...")
+        logger.debug("auth_callback: state=%s, code=%s...", state, code[:20] if code else 'None')
         
         if auth_service.handle_callback(code, state):
-            print(f"[DEBUG] auth_callback: 認証成功 user_id={state}")
+            logger.debug("auth_callback: 認証成功 user_id=%s", state)
             # 既存ユーザー情報をデータベースから読み込む
             user_info = session_manager.get_user_info(state)
-            print(f"[DEBUG] auth_callback: 既存ユーザー情報={user_info}")
+            logger.debug("auth_callback: 既存ユーザー情報=%s", user_info)
             
             if user_info and user_info.get('company_name'):
                 # 既存ユーザーの場合：セッションを復元してメインメニューを表示
-                print(f"[DEBUG] auth_callback: 既存ユーザーとして処理 user_id={state}")
+                logger.debug("auth_callback: 既存ユーザーとして処理 user_id=%s", state)
                 session_manager.create_session(state, {
                     'state': 'menu',
                     'registration_complete': True,
@@ -227,73 +523,28 @@ def auth_callback():
                     'notes': '',
                     'email': ''
                 })
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        # メインメニューを表示
-                        buttons_template = TemplateMessage(
-                            altText='メインメニュー',
-                            template=ButtonsTemplate(
-                                title='✅ ログイン完了',
-                                text='何をお手伝いしますか？',
-                                actions=[
-                                    PostbackAction(
-                                        label='📄 見積書を作る',
-                                        data='create_estimate'
-                                    ),
-                                    PostbackAction(
-                                        label='📋 請求書を作る',
-                                        data='create_invoice'
-                                    ),
-                                    PostbackAction(
-                                        label='⚙️ 会社情報を編集',
-                                        data='edit_company_info'
-                                    )
-                                ]
-                            )
-                        )
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=state,
-                                messages=[buttons_template]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[WARNING] Failed to send push message: {e}")
-                    import traceback
-                    traceback.print_exc()
+                # メインメニューを表示
+                send_messages(state, [LOGIN_MENU_TEMPLATE], 'auth_callback')
             else:
                 # 新規ユーザーの場合：会社情報登録を促す
-                print(f"[DEBUG] auth_callback: 新規ユーザーとして処理 user_id={state}")
+                logger.debug("auth_callback: 新規ユーザーとして処理 user_id=%s", state)
                 session_manager.create_session(state, {'state': 'registration', 'step': 'company_name'})
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=state,
-                                messages=[TextMessage(text="✅ Google認証が完了しました！\n\n次に会社情報を登録しましょう。\n会社名（法人・屋号含む）を教えてください。")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[WARNING] Failed to send push message: {e}")
-                    import traceback
-                    traceback.print_exc()
+                send_messages(state, MSGS_GOOGLE_AUTH_DONE, 'auth_callback')
             return "認証が完了しました。LINEに戻って続行してください。"
         else:
-            print(f"[DEBUG] auth_callback: 認証失敗 user_id={state}")
+            logger.debug("auth_callback: 認証失敗 user_id=%s", state)
             # まれに二重コールバック等でhandle_callbackがFalseでも
             # 既にトークンが保存済みのことがあるため、最終確認を行う
             try:
                 if auth_service.is_authenticated(state):
-                    print(f"[DEBUG] auth_callback: 失敗判定だったがトークン確認で認証済み user_id={state}")
+                    logger.debug("auth_callback: 失敗判定だったがトークン確認で認証済み user_id=%s", state)
                     # 既存ユーザー情報をデータベースから読み込む
                     user_info = session_manager.get_user_info(state)
-                    print(f"[DEBUG] auth_callback: 既存ユーザー情報={user_info}")
+                    logger.debug("auth_callback: 既存ユーザー情報=%s", user_info)
                     
                     if user_info and user_info.get('company_name'):
                         # 既存ユーザーの場合：セッションを復元してメインメニューを表示
-                        print(f"[DEBUG] auth_callback: 既存ユーザーとして処理 user_id={state}")
+                        logger.debug("auth_callback: 既存ユーザーとして処理 user_id=%s", state)
                         session_manager.create_session(state, {
                             'state': 'menu',
                             'registration_complete': True,
@@ -308,119 +559,56 @@ def auth_callback():
                             'notes': '',
                             'email': ''
                         })
-                        try:
-                            with ApiClient(configuration) as api_client:
-                                line_bot_api = MessagingApi(api_client)
-                                # メインメニューを表示
-                                buttons_template = TemplateMessage(
-                                    altText='メインメニュー',
-                                    template=ButtonsTemplate(
-                                        title='✅ ログイン完了',
-                                        text='何をお手伝いしますか？',
-                                        actions=[
-                                            PostbackAction(
-                                                label='📄 見積書を作る',
-                                                data='create_estimate'
-                                            ),
-                                            PostbackAction(
-                                                label='📋 請求書を作る',
-                                                data='create_invoice'
-                                            ),
-                                            PostbackAction(
-                                                label='⚙️ 会社情報を編集',
-                                                data='edit_company_info'
-                                            )
-                                        ]
-                                    )
-                                )
-                                line_bot_api.push_message(
-                                    PushMessageRequest(
-                                        to=state,
-                                        messages=[buttons_template]
-                                    )
-                                )
-                        except Exception as e:
-                            print(f"[WARNING] Failed to send push message: {e}")
-                            import traceback
-                            traceback.print_exc()
+                        # メインメニューを表示
+                        send_messages(state, [LOGIN_MENU_TEMPLATE], 'auth_callback')
                     else:
                         # 新規ユーザーの場合：会社情報登録を促す
-                        print(f"[DEBUG] auth_callback: 新規ユーザーとして処理 user_id={state}")
+                        logger.debug("auth_callback: 新規ユーザーとして処理 user_id=%s", state)
                         session_manager.create_session(state, {'state': 'registration', 'step': 'company_name'})
-                        try:
-                            with ApiClient(configuration) as api_client:
-                                line_bot_api = MessagingApi(api_client)
-                                line_bot_api.push_message(
-                                    PushMessageRequest(
-                                        to=state,
-                                        messages=[TextMessage(text="✅ Google認証が完了しました！\n\n次に会社情報を登録しましょう。\n会社名（法人・屋号含む）を教えてください。")]
-                                    )
-                                )
-                        except Exception as e:
-                            print(f"[WARNING] Failed to send push message: {e}")
-                            import traceback
-                            traceback.print_exc()
+                        send_messages(state, MSGS_GOOGLE_AUTH_DONE, 'auth_callback')
                     return "認証が完了しました。LINEに戻って続行してください。"
             except Exception as e:
-                print(f"[WARNING] auth_callback: 認証済み再確認処理で例外: {e}")
+                logger.warning("auth_callback: 認証済み再確認処理で例外: %s", e)
 
             # 認証未完了時のみ失敗メッセージを送信
             try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    # 再認証用のURLを生成
-                    auth_url = auth_service.get_auth_url(state)
-                    if auth_url:
-                        message_text = f"❌ Google認証に失敗しました。\n\nトークンの有効期限が切れている可能性があります。\n\n再度認証を行ってください：\n{auth_url}"
-                    else:
-                        message_text = "❌ Google認証に失敗しました。\n\nトークンの有効期限が切れている可能性があります。\n\n再度認証を行ってください。"
-                    
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=state,
-                            messages=[TextMessage(text=message_text)]
-                        )
-                    )
+                # 再認証用のURLを生成
+                auth_url = auth_service.get_auth_url(state)
+                if auth_url:
+                    message_text = f"❌ Google認証に失敗しました。\n\nトークンの有効期限が切れている可能性があります。\n\n再度認証を行ってください：\n{auth_url}"
+                else:
+                    message_text = "❌ Google認証に失敗しました。\n\nトークンの有効期限が切れている可能性があります。\n\n再度認証を行ってください。"
+
+                send_text(state, message_text, 'auth_callback')
             except Exception as e:
-                print(f"[WARNING] Failed to send push message: {e}")
+                logger.warning("Failed to send push message: %s", e)
             return "認証に失敗しました。再度お試しください。"
     except Exception as e:
         logger.error(f"Auth callback error: {e}")
-        print(f"[DEBUG] auth_callback: 例外発生 {e}")
+        logger.debug("auth_callback: 例外発生 %s", e)
         
         # 例外発生時もプッシュメッセージで通知
-        try:
-            if state:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=state,
-                            messages=[TextMessage(text="❌ 認証エラーが発生しました。\n\nしばらく時間をおいて再度お試しください。")]
-                        )
-                    )
-        except Exception as push_error:
-            print(f"[WARNING] Failed to send push message: {push_error}")
+        if state:
+            send_text(state, "❌ 認証エラーが発生しました。\n\nしばらく時間をおいて再度お試しください。", 'auth_callback')
         
         return "認証エラーが発生しました。"
 
-@handler.add(MessageEvent)
 def handle_message(event):
     """テキストメッセージの処理"""
-    print("[DEBUG] handle_message: 開始")
-    print(f"[DEBUG] handle_message: イベントタイプ: {type(event)}")
-    print(f"[DEBUG] handle_message: イベント内容: {event}")
+    logger.debug("handle_message: 開始")
+    logger.debug("handle_message: イベントタイプ: %s", type(event))
+    logger.debug("handle_message: イベント内容: %s", event)
     user_id = event.source.user_id
     # v3ではevent.messageはTextMessageContent型
     text = event.message.text if hasattr(event.message, 'text') else ''
-    print(f"[DEBUG] handle_message: メッセージテキスト: {text}")
+    logger.debug("handle_message: メッセージテキスト: %s", text)
 
     # セッション情報の取得（制限チェック用）
     session = session_manager.get_session(user_id)
     email = session.get('email') if session else None
 
     # キャンセル対応
-    if text.strip() == "キャンセル":
+    if text.strip() in CANCEL_WORDS:
         session_manager.update_session(user_id, {'state': 'menu', 'step': None})
         show_main_menu(event)
         return
@@ -428,98 +616,50 @@ def handle_message(event):
     # 制限されたユーザーの処理
     if session and session.get('state') == 'restricted':
         logger.info(f"Restricted user {user_id} attempted to use service")
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                # LINE Bot SDK v3の正しい形式でTemplateMessageを作成
-                template = ButtonsTemplate(
-                    title="AI経理秘書の利用制限",
-                    text="AI経理秘書は解約されています。公式LINEで再登録してください。",
-                    actions=[
-                        URIAction(
-                            label="AIコレクションズ公式LINE",
-                            uri="https://lin.ee/eyYpOKq"
-                        ),
-                        URIAction(
-                            label="サービス詳細",
-                            uri="https://lp-production-9e2c.up.railway.app/"
-                        )
-                    ]
-                )
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TemplateMessage(alt_text="AI経理秘書の利用制限", template=template)]
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Failed to send restriction message: {e}")
+        send_restriction_template(user_id)
         return
 
     logger.info(f"Received message from {user_id}: {text}")
-    print(f"[DEBUG] handle_message: reply_token={event.reply_token}, event={event}")
+    logger.debug("handle_message: reply_token=%s", event.reply_token)
     
     # セッション情報の取得
     step = session.get('step') if session else None
 
-    print(f"[DEBUG] handle_message: user_id={user_id}, text={text}, session={session}, step={step}")
+    logger.debug("handle_message: user_id=%s, text=%s, session=%s, step=%s", user_id, text, session, step)
     
     # セッションの詳細情報を出力
     if session:
-        print(f"[DEBUG] handle_message: session.state={session.get('state')}, session.step={session.get('step')}")
-        print(f"[DEBUG] handle_message: session.registration_complete={session.get('registration_complete')}")
+        logger.debug("handle_message: session.state=%s, session.step=%s", session.get('state'), session.get('step'))
+        logger.debug("handle_message: session.registration_complete=%s", session.get('registration_complete'))
         
         # 会社名入力時の詳細ログ
         if session.get('state') == 'registration' and session.get('step') == 'company_name':
-            print(f"[DEBUG] handle_message: 会社名入力ステップ検出 - text={text}")
+            logger.debug("handle_message: 会社名入力ステップ検出 - text=%s", text)
     else:
-        print(f"[DEBUG] handle_message: セッションが存在しません")
+        logger.debug("handle_message: セッションが存在しません")
 
     # 最終確認ステップの返答処理
     if step == 'confirm':
-        if text.strip() == 'はい':
+        if text.strip() in YES_WORDS:
             session_manager.update_session(user_id, {'step': 'generate'})
             doc_type = session.get('document_type', 'estimate')
             doc_label = '見積書' if doc_type == 'estimate' else '請求書'
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=f"{doc_label}を作成中です…")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_message: push_message送信時に例外発生: {e}")
-            generate_document(event, session)
+            submit_generate_document(event, session, progress_text=f"{doc_label}を作成中です…")
             return
-        elif text.strip() == '修正する':
+        elif text.strip() in FIX_WORDS:
             session_manager.update_session(user_id, {'step': 'items'})
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="品目の修正を行います。続けて品目を入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000\n\n完了したら「完了」と入力してください。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_message: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
+            send_messages(user_id, MSGS_ITEMS_FIX, 'handle_message')
             return
     
     if not session:
         # セッションがない場合、既存ユーザー情報をデータベースから読み込む
         user_info = session_manager.get_user_info(user_id)
-        print(f"[DEBUG] handle_message: セッションなし、既存ユーザー情報={user_info}")
+        logger.debug("handle_message: セッションなし、既存ユーザー情報=%s", user_info)
         
         # 既存ユーザーで登録完了している場合：セッションを復元してメインメニューを表示
         if user_info and user_info.get('company_name') and auth_service.is_authenticated(user_id):
-            print(f"[DEBUG] handle_message: 既存ユーザーとして処理 user_id={user_id}")
-            session_manager.create_session(user_id, {
+            logger.debug("handle_message: 既存ユーザーとして処理 user_id=%s", user_id)
+            session = {
                 'state': 'menu',
                 'registration_complete': True,
                 'step': None,
@@ -532,9 +672,9 @@ def handle_message(event):
                 'items': [],
                 'notes': '',
                 'email': ''
-            })
-            # セッション復元後、メッセージを処理
-            session = session_manager.get_session(user_id)
+            }
+            session_manager.create_session(user_id, session)
+            # セッション復元後、メッセージを処理（保存した内容をそのまま使い、再取得しない）
             handle_existing_user(event, session, text)
             return
         
@@ -542,29 +682,9 @@ def handle_message(event):
         auth_url = auth_service.get_auth_url(user_id)
         if auth_url:
             session_manager.create_session(user_id, {'state': 'registration', 'step': 'google_auth'})
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="👩‍💼LINE見積書・請求書Botへようこそ！\n\nGoogle認証を行ってください。\n以下のリンクからGoogle Driveへのアクセスを許可してください：\n\n" + auth_url)]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_message: push_message送信時に例外発生: {e}")
+            send_text(user_id, "👩‍💼LINE見積書・請求書Botへようこそ！\n\nGoogle認証を行ってください。\n以下のリンクからGoogle Driveへのアクセスを許可してください：\n\n" + auth_url, 'handle_message')
         else:
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。しばらく時間をおいて再度お試しください。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_message: push_message送信時に例外発生: {e}")
+            send_text(user_id, "❌ Google認証URLの生成に失敗しました。しばらく時間をおいて再度お試しください。", 'handle_message')
         return
     
 
@@ -572,7 +692,146 @@ def handle_message(event):
     # 既存ユーザーの処理
     handle_existing_user(event, session, text)
 
-@handler.add(PostbackEvent)
+def _on_create_estimate(event, session):
+    # state/document_type/stepはshow_document_creation_menu内でまとめて更新する
+    show_document_creation_menu(event, 'estimate')
+
+def _on_create_invoice(event, session):
+    # state/document_type/stepはshow_document_creation_menu内でまとめて更新する
+    show_document_creation_menu(event, 'invoice')
+
+def _on_edit_company_info(event, session):
+    user_id = event.source.user_id
+    # 認証済みユーザーかチェック
+    if auth_service.is_authenticated(user_id):
+        # 認証済みの場合は直接会社情報編集に進む
+        session_manager.update_session(user_id, {
+            'state': 'registration',
+            'step': 'company_name'
+        })
+        send_messages(user_id, MSGS_EDIT_COMPANY_START, 'edit_company_info')
+    else:
+        # 未認証の場合は認証から開始
+        session_manager.update_session(user_id, {
+            'state': 'registration',
+            'step': 'google_auth'
+        })
+        auth_url = auth_service.get_auth_url(user_id)
+        if auth_url:
+            send_text(user_id, "🔐 会社情報を編集するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url, 'edit_company_info')
+        else:
+            send_messages(user_id, MSGS_AUTH_URL_FAILED, 'edit_company_info')
+
+def _on_confirm_generate(event, session):
+    user_id = event.source.user_id
+    if not session:
+        # セッションが存在しない場合は新規作成
+        session = {
+            'state': 'document_creation',
+            'document_type': 'estimate',
+            'step': 'generate'
+        }
+        session_manager.create_session(user_id, session)
+    else:
+        session['step'] = 'generate'
+        session_manager.create_session(user_id, session)
+    # 進行中メッセージをreplyで送信
+    doc_type = session.get('document_type', 'estimate')
+    doc_label = '見積書' if doc_type == 'estimate' else '請求書'
+    submit_generate_document(event, session, progress_text=f"{doc_label}を作成中です…")
+
+def _on_edit_items(event, session):
+    user_id = event.source.user_id
+    session_manager.update_session(user_id, {'step': 'items'})
+    send_messages(user_id, MSGS_ITEMS_FIX, 'handle_postback')
+
+def _on_existing_sheet(event, session):
+    # 既存シートに追加
+    user_id = event.source.user_id
+    doc_type = (session or {}).get('document_type', 'estimate')
+    session_manager.update_session(user_id, {
+        'state': 'document_creation',
+        'document_type': doc_type,
+        'step': 'select_existing_sheet',
+        'creation_method': 'existing_sheet',
+        'items': []
+    })
+    # シート一覧を表示
+    show_sheet_list(user_id, doc_type, page=0)
+
+def _on_cancel_creation(event, session):
+    # 作成をキャンセル
+    session_manager.update_session(event.source.user_id, {'state': 'menu', 'step': None})
+    show_main_menu(event)
+
+def _on_next_page(event, session, arg):
+    # 次のページを表示
+    match = NEXT_PAGE_ARG_PATTERN.match(arg)
+    if match:
+        show_sheet_list(event.source.user_id, match.group(1), page=int(match.group(2)))
+
+def _on_new_sheet(event, session, doc_type):
+    # 新規シート作成
+    user_id = event.source.user_id
+    session_manager.update_session(user_id, {
+        'state': 'document_creation',
+        'document_type': doc_type,
+        'step': 'client_name',
+        'creation_method': 'new_sheet',
+        'items': []
+    })
+    doc_name = "見積書" if doc_type == 'estimate' else "請求書"
+    send_text(user_id, f"📄{doc_name}の新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_postback')
+
+def _on_select_sheet(event, session, spreadsheet_id):
+    # 既存シートを選択
+    user_id = event.source.user_id
+    # セッションが存在しない場合は新規作成
+    if not session:
+        session_manager.create_session(user_id, {
+            'state': 'document_creation',
+            'document_type': 'estimate',  # デフォルト値
+            'step': 'client_name',
+            'creation_method': 'existing_sheet',
+            'selected_spreadsheet_id': spreadsheet_id
+        })
+        doc_name = "見積書"
+    else:
+        doc_type = session.get('document_type', 'estimate')  # デフォルト値を設定
+        session_manager.update_session(user_id, {
+            'selected_spreadsheet_id': spreadsheet_id,
+            'step': 'client_name',
+            'creation_method': 'existing_sheet'
+        })
+        doc_name = "見積書" if doc_type == 'estimate' else "請求書"
+
+    send_text(user_id, f"📄{doc_name}の既存シートに追加します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_postback')
+
+# Postbackのdataと処理の対応（完全一致を先に引き、無ければ接頭辞で判定する）
+POSTBACK_ROUTES = {
+    'create_estimate': _on_create_estimate,
+    'create_invoice': _on_create_invoice,
+    'edit_company_info': _on_edit_company_info,
+    'confirm_generate': _on_confirm_generate,
+    'edit_items': _on_edit_items,
+    'existing_sheet': _on_existing_sheet,
+    'cancel_creation': _on_cancel_creation,
+}
+
+# メニュー画面でのテキスト入力（メニューボタンのPostbackと同じ処理を行う）
+MENU_TEXT_ROUTES = {
+    '見積書を作る': _on_create_estimate,
+    '請求書を作る': _on_create_invoice,
+    '会社情報を編集': _on_edit_company_info,
+}
+
+# 接頭辞付きのdata（接頭辞を除いた残りをハンドラに渡す）
+PREFIX_ROUTES = (
+    ('next_page_', _on_next_page),
+    ('new_sheet_', _on_new_sheet),
+    ('select_sheet_', _on_select_sheet),
+)
+
 def handle_postback(event):
     """Postbackイベントの処理"""
     user_id = event.source.user_id
@@ -582,242 +841,28 @@ def handle_postback(event):
     
     # セッション情報の取得（制限チェック用）
     session = session_manager.get_session(user_id)
-    email = session.get('email') if session else None
     
     # 制限されたユーザーの処理
     if session and session.get('state') == 'restricted':
         logger.info(f"Restricted user {user_id} attempted to use service (postback)")
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                # LINE Bot SDK v3の正しい形式でTemplateMessageを作成
-                template = ButtonsTemplate(
-                    title="AI経理秘書の利用制限",
-                    text="AI経理秘書は解約されています。公式LINEで再登録してください。",
-                    actions=[
-                        URIAction(
-                            label="AIコレクションズ公式LINE",
-                            uri="https://lin.ee/eyYpOKq"
-                        ),
-                        URIAction(
-                            label="サービス詳細",
-                            uri="https://lp-production-9e2c.up.railway.app/"
-                        )
-                    ]
-                )
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TemplateMessage(alt_text="AI経理秘書の利用制限", template=template)]
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Failed to send restriction message: {e}")
-        return
-    
-    if data == 'create_estimate':
-        session_manager.update_session(user_id, {
-            'state': 'document_creation',
-            'document_type': 'estimate',
-            'step': 'company_name'
-        })
-        show_document_creation_menu(event, 'estimate')
-    
-    elif data == 'create_invoice':
-        session_manager.update_session(user_id, {
-            'state': 'document_creation',
-            'document_type': 'invoice',
-            'step': 'company_name'
-        })
-        show_document_creation_menu(event, 'invoice')
-    
-    elif data == 'edit_company_info':
-        # 認証済みユーザーかチェック
-        if auth_service.is_authenticated(user_id):
-            # 認証済みの場合は直接会社情報編集に進む
-            session_manager.update_session(user_id, {
-                'state': 'registration',
-                'step': 'company_name'
-            })
-            try:
-                print(f"[DEBUG] handle_postback: reply_token={event.reply_token}, event={event}")
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="会社情報の編集を開始します。\n\n会社名を教えてください。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-        else:
-            # 未認証の場合は認証から開始
-            session_manager.update_session(user_id, {
-                'state': 'registration',
-                'step': 'google_auth'
-            })
-            auth_url = auth_service.get_auth_url(user_id)
-            if auth_url:
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="🔐 会社情報を編集するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url)]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-            else:
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-    
-    elif data == 'confirm_generate':
-        session = session_manager.get_session(user_id)
-        if not session:
-            # セッションが存在しない場合は新規作成
-            session_manager.create_session(user_id, {
-                'state': 'document_creation',
-                'document_type': 'estimate',
-                'step': 'generate'
-            })
-            session = session_manager.get_session(user_id)
-        
-        session_manager.update_session(user_id, {'step': 'generate'})
-        # 進行中メッセージをreplyで送信
-        doc_type = session.get('document_type', 'estimate')
-        doc_label = '見積書' if doc_type == 'estimate' else '請求書'
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"{doc_label}を作成中です…")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-        generate_document(event, session)
-        return
-    elif data == 'edit_items':
-        session = session_manager.get_session(user_id)
-        session_manager.update_session(user_id, {'step': 'items'})
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text="品目の修正を行います。続けて品目を入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000\n\n完了したら「完了」と入力してください。")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+        send_restriction_template(user_id)
         return
     
-    elif data == 'existing_sheet':
-        # 既存シートに追加
-        session = session_manager.get_session(user_id)
-        doc_type = session.get('document_type', 'estimate')
-        session_manager.update_session(user_id, {
-            'state': 'document_creation',
-            'document_type': doc_type,
-            'step': 'select_existing_sheet',
-            'creation_method': 'existing_sheet',
-            'items': []
-        })
-        # シート一覧を表示
-        show_sheet_list(user_id, doc_type, page=0)
+    handler = POSTBACK_ROUTES.get(data)
+    if handler:
+        handler(event, session)
         return
+    for prefix, prefix_handler in PREFIX_ROUTES:
+        if data.startswith(prefix):
+            prefix_handler(event, session, data[len(prefix):])
+            return
+    show_main_menu(event)
 
-    elif data.startswith('next_page_'):
-        # 次のページを表示
-        parts = data.replace('next_page_', '').split('_')
-        if len(parts) >= 2:
-            doc_type = parts[0]
-            page = int(parts[1])
-            show_sheet_list(user_id, doc_type, page=page)
-        return
-    elif data.startswith('new_sheet_'):
-        # 新規シート作成
-        doc_type = data.replace('new_sheet_', '')
-        session_manager.update_session(user_id, {
-            'state': 'document_creation',
-            'document_type': doc_type,
-            'step': 'client_name',
-            'creation_method': 'new_sheet',
-            'items': []
-        })
-        doc_name = "見積書" if doc_type == 'estimate' else "請求書"
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"📄{doc_name}の新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-        return
-    elif data.startswith('select_sheet_'):
-        # 既存シートを選択
-        spreadsheet_id = data.replace('select_sheet_', '')
-        session = session_manager.get_session(user_id)
-        
-        # セッションが存在しない場合は新規作成
-        if not session:
-            session_manager.create_session(user_id, {
-                'state': 'document_creation',
-                'document_type': 'estimate',  # デフォルト値
-                'step': 'client_name',
-                'creation_method': 'existing_sheet',
-                'selected_spreadsheet_id': spreadsheet_id
-            })
-            doc_name = "見積書"
-        else:
-            doc_type = session.get('document_type', 'estimate')  # デフォルト値を設定
-            session_manager.update_session(user_id, {
-                'selected_spreadsheet_id': spreadsheet_id,
-                'step': 'client_name',
-                'creation_method': 'existing_sheet'
-            })
-            doc_name = "見積書" if doc_type == 'estimate' else "請求書"
-        
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"📄{doc_name}の既存シートに追加します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_postback: push_message送信時に例外発生: {e}")
-        return
-    elif data == 'cancel_creation':
-        # 作成をキャンセル
-        session_manager.update_session(user_id, {'state': 'menu', 'step': None})
-        show_main_menu(event)
-        return
-    else:
-        show_main_menu(event)
+# Webhookイベント種別ごとのハンドラ
+WEBHOOK_EVENT_HANDLERS = {
+    'message': handle_message,
+    'postback': handle_postback,
+}
 
 def show_sheet_list(user_id, doc_type, page=0):
     """シート一覧を表示する関数"""
@@ -830,14 +875,7 @@ def show_sheet_list(user_id, doc_type, page=0):
             })
             auth_url = auth_service.get_auth_url(user_id)
             if auth_url:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="🔐 既存シートを確認するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url)]
-                        )
-                    )
+                send_text(user_id, "🔐 既存シートを確認するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url, 'show_sheet_list')
             return
         
         # 全件取得してページネーション（botで作成したシートのみ）
@@ -845,22 +883,15 @@ def show_sheet_list(user_id, doc_type, page=0):
         doc_name = "見積書" if doc_type == 'estimate' else "請求書"
         
         if not all_spreadsheets:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"📄{doc_name}の既存シートが見つかりませんでした。\n\n新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                    )
-                )
+            send_text(user_id, f"📄{doc_name}の既存シートが見つかりませんでした。\n\n新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'show_sheet_list')
             session_manager.update_session(user_id, {
                 'step': 'client_name',
                 'creation_method': 'new_sheet'
             })
             return
         
-        # ページネーション処理
-        items_per_page = 10
+        # ページネーション処理（シート＋「次の候補」「新規作成」がQuickReplyの上限に収まる件数）
+        items_per_page = SHEET_LIST_PAGE_SIZE
         start_index = page * items_per_page
         end_index = start_index + items_per_page
         spreadsheets = all_spreadsheets[start_index:end_index]
@@ -871,20 +902,16 @@ def show_sheet_list(user_id, doc_type, page=0):
         
         # QuickReplyアイテムを作成
         quick_reply_items = []
-        for i, sheet in enumerate(spreadsheets, 1):
+        for sheet in spreadsheets:
             # シート名を短縮（長すぎる場合）
             sheet_name = sheet['name']
             if len(sheet_name) > 10:
                 sheet_name = sheet_name[:7] + "..."
-            
-            # 日付を整形
-            from datetime import datetime
-            modified_time = datetime.fromisoformat(sheet['modified_time'].replace('Z', '+00:00'))
-            formatted_date = modified_time.strftime('%m/%d')
+            formatted_date = sheet['modified_date']
             
             # ボタンラベルを作成（最大20文字に制限）
             button_label = f"{sheet_name} ({formatted_date})"
-            if len(button_label) > 20:
+            if len(button_label) > QUICK_REPLY_LABEL_MAX_LENGTH:
                 button_label = f"{sheet_name[:5]}... ({formatted_date})"
             
             quick_reply_items.append(QuickReplyItem(
@@ -904,37 +931,19 @@ def show_sheet_list(user_id, doc_type, page=0):
             ))
         
         # 新規作成ボタンを追加
-        quick_reply_items.append(QuickReplyItem(
-            action=PostbackAction(
-                label='🆕 新規作成',
-                data=f'new_sheet_{doc_type}'
-            )
-        ))
+        new_sheet_item = NEW_SHEET_QUICK_REPLY_ITEMS.get(doc_type) or _build_new_sheet_quick_reply_item(doc_type)
+        quick_reply_items.append(new_sheet_item)
         
         # QuickReplyを作成
         quick_reply = QuickReply(items=quick_reply_items)
         
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=explanation_text, quickReply=quick_reply)]
-                )
-            )
+        # 送信に失敗した場合は下の例外処理で新規作成に切り替えるため、ここでは例外をそのまま上げる
+        reply_token = current_reply_token(user_id)
+        reply_or_push(user_id, reply_token.take() if reply_token else None, [TextMessage(text=explanation_text, quickReply=quick_reply)])
     except Exception as e:
-        print(f"[ERROR] show_sheet_list: 例外発生: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("show_sheet_list: 例外発生: %s", e)
         doc_name = "見積書" if doc_type == 'estimate' else "請求書"
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=f"📄{doc_name}の既存シート選択でエラーが発生しました。\n\n新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                )
-            )
+        send_text(user_id, f"📄{doc_name}の既存シート選択でエラーが発生しました。\n\n新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'show_sheet_list')
         session_manager.update_session(user_id, {
             'step': 'client_name',
             'creation_method': 'new_sheet'
@@ -946,195 +955,93 @@ def handle_existing_user(event, session, text):
     user_id = event.source.user_id
     state = session.get('state', 'menu')
     
-    print(f"[DEBUG] handle_existing_user: user_id={user_id}, state={state}, text={text}, session={session}")
+    logger.debug("handle_existing_user: user_id=%s, state=%s, text=%s, session=%s", user_id, state, text, session)
     
-    if state == 'registration':
-        print(f"[DEBUG] handle_existing_user: registration状態でhandle_registrationを呼び出し")
-        handle_registration(event, session, text)
-    elif state == 'menu':
-        print(f"[DEBUG] handle_existing_user: menu状態でhandle_menuを呼び出し")
-        handle_menu(event, session, text)
-    elif state == 'document_creation':
-        print(f"[DEBUG] handle_existing_user: document_creation状態でhandle_document_creationを呼び出し")
-        handle_document_creation(event, session, text)
+    state_handler = SESSION_STATE_HANDLERS.get(state)
+    if state_handler:
+        state_handler(event, session, text)
     else:
-        print(f"[DEBUG] handle_existing_user: 不明な状態({state})のためメニューに戻す")
+        logger.debug("handle_existing_user: 不明な状態(%s)のためメニューに戻す", state)
         # 不明な状態の場合はメニューに戻す
         session_manager.update_session(user_id, {'state': 'menu'})
         show_main_menu(event)
 
 def handle_registration(event, session, text):
     """初期登録フローの処理"""
-    print("[DEBUG] handle_registration: 開始")
+    logger.debug("handle_registration: 開始")
     user_id = event.source.user_id
     step = session.get('step')
     
     if step == 'google_auth':
         # Google認証の確認
-        print(f"[DEBUG] handle_registration: user_id={user_id}")
-        print(f"[DEBUG] handle_registration: is_authenticated={auth_service.is_authenticated(user_id)}")
-        if auth_service.is_authenticated(user_id):
-            print(f"[DEBUG] handle_registration: 認証完了。会社情報入力に進む。")
-            session_manager.update_session(user_id, {
-                'step': 'company_name'
-            })
-            # セッション更新後の状態を確認
-            updated_session = session_manager.get_session(user_id)
-            print(f"[DEBUG] handle_registration: セッション更新後: {updated_session}")
-            print(f"[DEBUG] handle_registration: 次のステップ: {updated_session.get('step') if updated_session else 'None'}")
-            # ここで、同じメッセージ内容でcompany_nameステップを即時処理
-            # ただし、textが空でなければ会社名として扱う
-            if text.strip():
-                print(f"[DEBUG] handle_registration: google_auth直後のメッセージも会社名として処理")
-                # 再帰呼び出しでcompany_nameステップを処理
-                handle_registration(event, updated_session, text)
-            return
+        authenticated = auth_service.is_authenticated(user_id)
+        logger.debug("handle_registration: user_id=%s, is_authenticated=%s", user_id, authenticated)
+        if authenticated:
+            logger.debug("handle_registration: 認証完了。会社情報入力に進む。")
+            if not text.strip():
+                session_manager.update_session(user_id, {
+                    'step': 'company_name'
+                })
+                return
+            # 同じメッセージを会社名として下のcompany_nameステップでそのまま処理する
+            # （会社名と次のステップはcompany_nameステップ側でまとめて保存する）
+            logger.debug("handle_registration: google_auth直後のメッセージも会社名として処理")
+            step = 'company_name'
         else:
-            print(f"[DEBUG] handle_registration: 認証未完了 user_id={user_id}")
+            logger.debug("handle_registration: 認証未完了 user_id=%s", user_id)
             auth_url = auth_service.get_auth_url(user_id)
-            print(f"[DEBUG] handle_registration: auth_url={auth_url}")
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    if auth_url:
-                        print(f"[DEBUG] handle_registration: 認証URL送信前 reply_token={event.reply_token}, event={event}")
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="🔐 Google認証が完了していません。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url)]
-                            )
-                        )
-                        print(f"[DEBUG] handle_registration: 認証URL送信完了")
-                    else:
-                        print(f"[DEBUG] handle_registration: 認証URL生成失敗 reply_token={event.reply_token}, event={event}")
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。")]
-                            )
-                        )
-            except Exception as e:
-                print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
+            logger.debug("handle_registration: auth_url=%s", auth_url)
+            if auth_url:
+                send_text(user_id, "🔐 Google認証が完了していません。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url, 'handle_registration')
+            else:
+                send_messages(user_id, MSGS_AUTH_URL_FAILED, 'handle_registration')
             return
     
-    elif step == 'company_name':
-        print(f"[DEBUG] handle_registration: step=company_name, text={text}, session={session}")
-        print(f"[DEBUG] handle_registration: 会社名保存前のセッション: {session}")
+    if step == 'company_name':
+        logger.debug("handle_registration: step=company_name, text=%s, session=%s", text, session)
 
         session_manager.update_session(user_id, {
             'company_name': text,
             'step': 'name'
         })
 
-        # セッション更新後の状態を確認
-        updated_session = session_manager.get_session(user_id)
-        print(f"[DEBUG] handle_registration: 会社名保存後のセッション: {updated_session}")
-        print(f"[DEBUG] handle_registration: 次のステップ: {updated_session.get('step') if updated_session else 'None'}")
-
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 会社名を「{text}」に設定しました。\n\n次に代表者名または担当者名を入力してください。\n例：山田太郎")]
-                    )
-                )
-                print(f"[DEBUG] handle_registration: 代表者名入力メッセージ送信完了")
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+        send_text(user_id, f"✅ 会社名を「{text}」に設定しました。\n\n次に代表者名または担当者名を入力してください。\n例：山田太郎", 'handle_registration')
 
     elif step == 'name':
-        print(f"[DEBUG] handle_registration: step=name, text={text}, session={session}")
+        logger.debug("handle_registration: step=name, text=%s, session=%s", text, session)
         session_manager.update_session(user_id, {
             'name': text,
             'step': 'address'
         })
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 名前を「{text}」に設定しました。\n\n次に住所を入力してください。\n例：東京都千代田区丸の内1-1-1")]
-                    )
-                )
-                print(f"[DEBUG] handle_registration: 住所入力メッセージ送信完了")
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+        send_text(user_id, f"✅ 名前を「{text}」に設定しました。\n\n次に住所を入力してください。\n例：東京都千代田区丸の内1-1-1", 'handle_registration')
     
     elif step == 'address':
-        print(f"[DEBUG] handle_registration: step=address, text={text}, session={session}")
+        logger.debug("handle_registration: step=address, text=%s, session=%s", text, session)
         session_manager.update_session(user_id, {
             'address': text,
             'step': 'phone_number'
         })
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 住所を「{text}」に設定しました。\n\n次に電話番号を入力してください。\n例：03-1234-5678")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
+        send_text(user_id, f"✅ 住所を「{text}」に設定しました。\n\n次に電話番号を入力してください。\n例：03-1234-5678", 'handle_registration')
 
     elif step == 'phone_number':
-        print(f"[DEBUG] handle_registration: step=phone_number, text={text}, session={session}")
+        logger.debug("handle_registration: step=phone_number, text=%s, session=%s", text, session)
         session_manager.update_session(user_id, {
             'phone_number': text,
             'step': 'bank_account'
         })
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 電話番号を「{text}」に設定しました。\n\n次に振込先銀行口座を教えてください。\n（例：○○銀行 ○○支店 普通 1234567）")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
+        send_text(user_id, f"✅ 電話番号を「{text}」に設定しました。\n\n次に振込先銀行口座を教えてください。\n（例：○○銀行 ○○支店 普通 1234567）", 'handle_registration')
     
     elif step == 'bank_account':
-        print(f"[DEBUG] handle_registration: step=bank_account, text={text}, session={session}")
+        logger.debug("handle_registration: step=bank_account, text=%s, session=%s", text, session)
         session_manager.update_session(user_id, {
             'bank_account': text,
             'step': 'bank_account_holder'
         })
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 銀行口座を「{text}」に設定しました。\n\n最後に口座名義を入力してください。\n例：カ）サンプルカイシャ または ヤマダタロウ")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
+        send_text(user_id, f"✅ 銀行口座を「{text}」に設定しました。\n\n最後に口座名義を入力してください。\n例：カ）サンプルカイシャ または ヤマダタロウ", 'handle_registration')
 
     elif step == 'bank_account_holder':
-        print(f"[DEBUG] handle_registration: step=bank_account_holder, text={text}, session={session}")
+        logger.debug("handle_registration: step=bank_account_holder, text=%s, session=%s", text, session)
         # 口座名義入力完了後、ユーザー情報を永続化して登録完了
-        session_manager.update_session(user_id, {
-            'bank_account_holder': text
-        })
-
         # ユーザー情報を永続化
         user_info = {
             'company_name': session.get('company_name'),
@@ -1162,135 +1069,29 @@ def handle_registration(event, session, text):
             'email': ''
         })
 
-        # 登録完了メッセージとメインメニューを一緒に送信
-        try:
-            print(f"[DEBUG] handle_registration: reply_token={event.reply_token}, event={event}")
-            show_main_menu(event)
-        except Exception as e:
-            print(f"[ERROR] handle_registration: push_message送信時に例外発生: {e}")
+        # 登録完了メッセージとメインメニューを1回のAPI呼び出しでまとめて送信
+        send_messages(user_id, [TextMessage(text=MSG_REGISTRATION_DONE), MAIN_MENU_TEMPLATE], 'handle_registration')
 
 def handle_menu(event, session, text):
     """メインメニューの処理"""
-    print("[DEBUG] handle_menu: 開始")
-    if text == "見積書を作る":
-        session_manager.update_session(event.source.user_id, {
-            'state': 'document_creation',
-            'document_type': 'estimate',
-            'step': 'company_name'
-        })
-        show_document_creation_menu(event, 'estimate')
-    
-    elif text == "請求書を作る":
-        session_manager.update_session(event.source.user_id, {
-            'state': 'document_creation',
-            'document_type': 'invoice',
-            'step': 'company_name'
-        })
-        show_document_creation_menu(event, 'invoice')
-    
-    elif text == "会社情報を編集":
-        # 認証済みユーザーかチェック
-        if auth_service.is_authenticated(event.source.user_id):
-            # 認証済みの場合は直接会社情報編集に進む
-            session_manager.update_session(event.source.user_id, {
-                'state': 'registration',
-                'step': 'company_name'
-            })
-            try:
-                print(f"[DEBUG] handle_menu: reply_token={event.reply_token}, event={event}")
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="会社情報の編集を開始します。\n\n会社名を教えてください。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_menu: push_message送信時に例外発生: {e}")
-        else:
-            # 未認証の場合は認証から開始
-            session_manager.update_session(event.source.user_id, {
-                'state': 'registration',
-                'step': 'google_auth'
-            })
-            auth_url = auth_service.get_auth_url(event.source.user_id)
-            if auth_url:
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="🔐 会社情報を編集するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url)]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_menu: push_message送信時に例外発生: {e}")
-            else:
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_menu: push_message送信時に例外発生: {e}")
-    
+    logger.debug("handle_menu: 開始")
+    menu_action = MENU_TEXT_ROUTES.get(text)
+    if menu_action:
+        menu_action(event, session)
     else:
         show_main_menu(event)
 
 def show_main_menu(event):
     """メインメニューの表示"""
-    print("[DEBUG] show_main_menu: 開始")
+    logger.debug("show_main_menu: 開始")
     user_id = event.source.user_id
     
-    # ボタンテンプレートを使用したメニュー
-    buttons_template = TemplateMessage(
-        altText='メインメニュー',
-        template=ButtonsTemplate(
-            title='✅ 登録完了',
-            text='何をお手伝いしますか？',
-            actions=[
-                PostbackAction(
-                    label='📄 見積書を作る',
-                    data='create_estimate'
-                ),
-                PostbackAction(
-                    label='📋 請求書を作る',
-                    data='create_invoice'
-                ),
-                PostbackAction(
-                    label='⚙️ 会社情報を編集',
-                    data='edit_company_info'
-                )
-            ]
-        )
-    )
-    
-    try:
-        print(f"[DEBUG] show_main_menu: reply_token={event.reply_token}, event={event}")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[buttons_template]
-                )
-            )
-    except Exception as e:
-        print(f"[ERROR] show_main_menu: push_message送信時に例外発生: {e}")
+    send_messages(user_id, [MAIN_MENU_TEMPLATE], 'show_main_menu')
 
 def show_document_creation_menu(event, doc_type):
     """書類作成メニューの表示"""
-    print("[DEBUG] show_document_creation_menu: 開始")
-    doc_name = "見積書" if doc_type == 'estimate' else "請求書"
+    logger.debug("show_document_creation_menu: 開始")
     user_id = event.source.user_id
-    session = session_manager.get_session(user_id)
-    print(f"[DEBUG] show_document_creation_menu: user_id={user_id}, session={session}")
 
     # 書類作成方法の選択メニューを表示
     session_manager.update_session(user_id, {
@@ -1300,87 +1101,202 @@ def show_document_creation_menu(event, doc_type):
         'items': []
     })
     
-    # ボタンテンプレートを使用したメニュー
-    buttons_template = TemplateMessage(
-        altText=f'{doc_name}作成方法選択',
-        template=ButtonsTemplate(
-            title=f'📄 {doc_name}の作成',
-            text='どの方法で作成しますか？',
-            actions=[
-                PostbackAction(
-                    label='🆕 新規シートを作成',
-                    data=f'new_sheet_{doc_type}'
-                ),
-                PostbackAction(
-                    label='既存シート',
-                    data='existing_sheet'
-                ),
-                PostbackAction(
-                    label='❌ キャンセル',
-                    data='cancel_creation'
-                )
-            ]
-        )
-    )
-    
+    send_messages(user_id, [DOCUMENT_CREATION_MENU_TEMPLATES[doc_type]], 'show_document_creation_menu')
+
+def build_rich_text_summary(session):
+    """最終確認用の入力内容まとめを作成"""
+    get = session.get
+    company = get('company_name', '')
+    client = get('client_name', '')
+    items = get('items', [])
+    due_date = get('due_date', '')
+    doc_type = get('document_type', 'estimate')
+    # 合計金額と品目行を1回の走査で作る
+    total = 0
+    lines = []
+    append = lines.append
+    for item in items:
+        amount = item['amount']
+        total += amount
+        append(f"・{item['name']}（{item['quantity']}個 × {item['price']:,}円 = {amount:,}円）")
+    item_lines = '\n'.join(lines) if lines else '（なし）'
+    parts = [
+        SUMMARY_HEADER,
+        f"■ 会社名\n{company}\n\n",
+        f"■ 宛名\n{client}\n\n",
+        f"■ 品目\n{item_lines}\n\n",
+    ]
+    if doc_type == 'invoice' and due_date:
+        parts.append(f"■ 支払い期日\n{due_date}\n\n")
+    parts.append(f"------------------------------\n■ 合計金額\n{total:,}円\n==========\n\n")
+    parts.append(SUMMARY_CONFIRM_PROMPT)
+    return ''.join(parts)
+
+def _doc_step_select_existing_sheet(event, session, text):
+    """既存シート選択ステップ"""
+    user_id = event.source.user_id
+    doc_name = "見積書" if session.get('document_type') == 'estimate' else "請求書"
+    if text.strip() == "新規作成":
+        # 新規作成に切り替え
+        session_manager.update_session(user_id, {
+            'step': 'client_name',
+            'creation_method': 'new_sheet'
+        })
+        send_text(user_id, f"📄{doc_name}の新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_document_creation')
+    else:
+        # 既存シートIDとして処理
+        spreadsheet_id = text.strip()
+        session_manager.update_session(user_id, {
+            'selected_spreadsheet_id': spreadsheet_id,
+            'step': 'client_name'
+        })
+        send_text(user_id, f"📄{doc_name}の既存シートに追加します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_document_creation')
+
+def _doc_step_select_invoice_sheet(event, session, text):
+    """請求書シート選択ステップ（「シート選択:」以外の入力は無視する）"""
+    if not text.startswith('シート選択:'):
+        return
+    user_id = event.source.user_id
+    selected_sheet_id = text.replace('シート選択:', '').strip()
+    session_manager.update_session(user_id, {
+        'selected_invoice_sheet_id': selected_sheet_id,
+        'step': 'company_name'
+    })
+    send_text(user_id, "会社名を入力してください。", 'handle_document_creation')
+
+def _doc_step_company_name(event, session, text):
+    user_id = event.source.user_id
+    if text in YES_WORDS:
+        session_manager.update_session(user_id, {'step': 'client_name'})
+        send_text(user_id, "次に宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_document_creation')
+    elif text == "編集する":
+        session_manager.update_session(user_id, {'step': 'edit_company_name'})
+        send_text(user_id, "新しい会社名を入力してください。", 'handle_document_creation')
+    else:
+        # デフォルト処理：入力されたテキストを会社名として保存
+        session_manager.update_session(user_id, {
+            'company_name': text,
+            'step': 'client_name'
+        })
+        send_text(user_id, f"✅ 会社名を「{text}」に設定しました。\n\n次に宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様", 'handle_document_creation')
+
+def _doc_step_client_name(event, session, text):
+    user_id = event.source.user_id
+    # 新規品目入力の開始時に毎回 items を初期化して、
+    # 以前のセッションの品目が残って合計がズレないようにする
+    session_manager.update_session(user_id, {
+        'client_name': text,
+        'step': 'items',
+        'items': []
+    })
+    send_text(user_id, f"✅ 宛名を「{text}」に設定しました。\n\n次に品目を入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000\n\n最大10件まで入力できます。", 'handle_document_creation')
+
+def _doc_step_items(event, session, text):
+    user_id = event.source.user_id
+    items = session.get('items', [])
+
+    if len(items) >= 10 or text in DONE_WORDS:
+        if not items:
+            send_messages(user_id, MSGS_NO_ITEMS, 'handle_document_creation')
+            return
+        if session.get('document_type') == 'estimate':
+            # 見積書は最終確認へ
+            summary_text = build_rich_text_summary(session)
+            send_text(user_id, summary_text, 'handle_document_creation')
+            session_manager.update_session(user_id, {'step': 'confirm'})
+        else:
+            # 請求書は支払い期日を質問
+            send_messages(user_id, MSGS_ASK_DUE_DATE, 'handle_document_creation')
+            session_manager.update_session(user_id, {'step': 'due_date'})
+        return
+
     try:
-        print(f"[DEBUG] show_document_creation_menu: reply_token={event.reply_token}, event={event}")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[buttons_template]
-                )
-            )
+        item_match = ITEM_LINE_PATTERN.match(normalize_item_input(text))
+        if item_match:
+            item_name, quantity, price = item_match.groups()
+            quantity = kanji_num_to_int(quantity)
+            price = kanji_num_to_int(price)
+            items.append({
+                'name': item_name,
+                'price': price,
+                'quantity': quantity,
+                'amount': price * quantity
+            })
+            logger.debug("Item added: name=%s, quantity=%s, price=%s, amount=%s", item_name, quantity, price, price * quantity)
+            session_manager.update_session(user_id, {'items': items})
+            total = 0
+            for added in items:
+                total += added['amount']
+            response_text = f"✅ 品目を追加しました：{item_name}\n\n現在の品目数：{len(items)}/10\n合計金額：{total:,}円\n\n続けて品目を入力するか、「完了」と入力してください。"
+            logger.debug("handle_document_creation: reply_token=%s", event.reply_token)
+            send_text(user_id, response_text, 'handle_document_creation')
+        else:
+            logger.debug("handle_document_creation: reply_token=%s", event.reply_token)
+            send_messages(user_id, MSGS_ITEM_FORMAT_INVALID, 'handle_document_creation')
+    except ValueError:
+        logger.debug("handle_document_creation: reply_token=%s", event.reply_token)
+        send_messages(user_id, MSGS_ITEM_NOT_NUMBER, 'handle_document_creation')
     except Exception as e:
-        print(f"[ERROR] show_document_creation_menu: push_message送信時に例外発生: {e}")
+        logger.exception("handle_document_creation: push_message送信時に例外発生: %s", e)
+
+def _doc_step_due_date(event, session, text):
+    """請求書の場合の追加ステップ"""
+    user_id = event.source.user_id
+    try:
+        # YYYY-MM-DD形式の検証（存在しない日付はdate()がValueErrorを送出する）
+        # $は末尾の改行の手前でも一致してしまうためfullmatchで全体を検証する
+        due_date_match = DUE_DATE_PATTERN.fullmatch(text)
+        if not due_date_match:
+            raise ValueError(f"invalid due date: {text}")
+        # 入力そのままではなくゼロ埋めしたYYYY-MM-DDで保存する
+        due_date = date(*map(int, due_date_match.groups())).isoformat()
+    except ValueError:
+        send_text(user_id, "日付の形式が正しくありません。\n\n形式：YYYY-MM-DD\n例：2024-01-31", 'handle_document_creation')
+        return
+    # 支払い期日と次のステップは1回の更新でまとめて保存する
+    session_manager.update_session(user_id, {
+        'due_date': due_date,
+        'step': 'confirm'
+    })
+    session['due_date'] = due_date
+    # 支払い期日入力後、最終確認メッセージを表示
+    summary_text = build_rich_text_summary(session)
+    send_text(user_id, summary_text, 'handle_document_creation')
+
+def _doc_step_generate(event, session, text):
+    # 生成中、または生成に失敗してstepがgenerateのまま残っている場合。
+    # 再度呼び出せば生成中なら二重起動は抑止され、失敗後なら再試行になる
+    logger.debug("handle_document_creation: generate step - 書類生成処理を呼び出します")
+    submit_generate_document(event, session)
+
+# 書類作成中のstepごとの処理（handle_document_creationで使用）
+# notes, email, phone, representative, business_numberのステップは無い
+DOCUMENT_CREATION_STEP_HANDLERS = {
+    'select_existing_sheet': _doc_step_select_existing_sheet,
+    'select_invoice_sheet': _doc_step_select_invoice_sheet,
+    'company_name': _doc_step_company_name,
+    'client_name': _doc_step_client_name,
+    'items': _doc_step_items,
+    'due_date': _doc_step_due_date,
+    'generate': _doc_step_generate,
+}
 
 def handle_document_creation(event, session, text):
-    print("[DEBUG] handle_document_creation: 開始")
+    logger.debug("handle_document_creation: 開始")
     user_id = event.source.user_id
     # キャンセル対応
-    if text.strip() == "キャンセル":
+    if text.strip() in CANCEL_WORDS:
         session_manager.update_session(user_id, {'state': 'menu', 'step': None})
         show_main_menu(event)
         return
     step = session.get('step')
-    doc_type = session.get('document_type')
 
-    # build_rich_text_summaryを全体スコープで定義
-    def build_rich_text_summary(session):
-        company = session.get('company_name', '')
-        client = session.get('client_name', '')
-        items = session.get('items', [])
-        total = sum(item['amount'] for item in items)
-        due_date = session.get('due_date', '')
-        doc_type = session.get('document_type', 'estimate')
-        item_lines = '\n'.join([
-            f"・{item['name']}（{item['quantity']}個 × {item['price']:,}円 = {item['amount']:,}円）"
-            for item in items
-        ])
-        summary = (
-            "==========\n"
-            + "【最終確認】\n"
-            + "------------------------------\n"
-            + f"■ 会社名\n{company}\n\n"
-            + f"■ 宛名\n{client}\n\n"
-            + f"■ 品目\n{item_lines if item_lines else '（なし）'}\n\n"
-        )
-        if doc_type == 'invoice' and due_date:
-            summary += f"■ 支払い期日\n{due_date}\n\n"
-        summary += (
-            "------------------------------\n"
-            + f"■ 合計金額\n{total:,}円\n"
-            + "==========\n\n"
-            + "この内容で書類を生成してよろしいですか？\n"
-            + "（「はい」または「修正する」と入力してください）"
-        )
-        return summary
+    # 認証状態は下の2つのチェックで共通なので1回だけ確認する
+    authenticated = auth_service.is_authenticated(user_id)
 
     # registration_completeがTrueでもトークンが無い場合は認証フローに戻す
-    if session.get('registration_complete') and not auth_service.is_authenticated(user_id):
-        print(f"[ERROR] registration_completeはTrueだがGoogle認証トークンが無い。認証フローに戻します。")
+    if session.get('registration_complete') and not authenticated:
+        logger.error("registration_completeはTrueだがGoogle認証トークンが無い。認証フローに戻します。")
         session_manager.update_session(user_id, {
             'state': 'registration',
             'step': 'google_auth',
@@ -1388,486 +1304,146 @@ def handle_document_creation(event, session, text):
         })
         auth_url = auth_service.get_auth_url(user_id)
         if auth_url:
-            print(f"[DEBUG] handle_document_creation: 認証URL送信前 reply_token={event.reply_token}, event={event}")
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="🔐 Google認証が失われています。再度認証を完了してください：\n\n" + auth_url)]
-                        )
-                    )
-                print(f"[DEBUG] handle_document_creation: 認証URL送信完了")
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
+            logger.debug("handle_document_creation: 認証URL送信前 reply_token=%s", event.reply_token)
+            send_text(user_id, "🔐 Google認証が失われています。再度認証を完了してください：\n\n" + auth_url, 'handle_document_creation')
         else:
-            print(f"[DEBUG] handle_document_creation: 認証URL生成失敗 reply_token={event.reply_token}, event={event}")
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
+            logger.debug("handle_document_creation: 認証URL生成失敗 reply_token=%s", event.reply_token)
+            send_messages(user_id, MSGS_AUTH_URL_FAILED, 'handle_document_creation')
         return
 
     # 認証チェック
-    if not auth_service.is_authenticated(user_id):
-        print(f"[DEBUG] handle_document_creation: 認証未完了。Google認証にリダイレクト。user_id={user_id}")
+    if not authenticated:
+        logger.debug("handle_document_creation: 認証未完了。Google認証にリダイレクト。user_id=%s", user_id)
         session_manager.update_session(user_id, {
             'state': 'registration',
             'step': 'google_auth'
         })
         auth_url = auth_service.get_auth_url(user_id)
-        print(f"[DEBUG] handle_document_creation: auth_url={auth_url}")
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                if auth_url:
-                    print(f"[DEBUG] handle_document_creation: 認証URL送信前 reply_token={event.reply_token}, event={event}")
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="🔐 書類を作成するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url)]
-                        )
-                    )
-                    print(f"[DEBUG] handle_document_creation: 認証URL送信完了")
-                else:
-                    print(f"[DEBUG] handle_document_creation: 認証URL生成失敗 reply_token={event.reply_token}, event={event}")
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="❌ Google認証URLの生成に失敗しました。")]
-                        )
-                    )
-        except Exception as e:
-            print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+        logger.debug("handle_document_creation: auth_url=%s", auth_url)
+        if auth_url:
+            send_text(user_id, "🔐 書類を作成するにはGoogle認証が必要です。\n\n以下のリンクから認証を完了してください：\n\n" + auth_url, 'handle_document_creation')
+        else:
+            send_messages(user_id, MSGS_AUTH_URL_FAILED, 'handle_document_creation')
         return
     
     # 認証チェックが完了したら、以降のステップでは認証チェックを行わない
-    print(f"[DEBUG] handle_document_creation: 認証チェック完了。ステップ処理を続行。")
+    logger.debug("handle_document_creation: 認証チェック完了。ステップ処理を続行。")
 
-    # 既存シート選択ステップ
-    if step == 'select_existing_sheet':
-        if text.strip() == "新規作成":
-            # 新規作成に切り替え
-            session_manager.update_session(user_id, {
-                'step': 'client_name',
-                'creation_method': 'new_sheet'
-            })
-            doc_name = "見積書" if doc_type == 'estimate' else "請求書"
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=f"📄{doc_name}の新規作成を開始します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            return
-        else:
-            # 既存シートIDとして処理
-            spreadsheet_id = text.strip()
-            session_manager.update_session(user_id, {
-                'selected_spreadsheet_id': spreadsheet_id,
-                'step': 'client_name'
-            })
-            doc_name = "見積書" if doc_type == 'estimate' else "請求書"
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=f"📄{doc_name}の既存シートに追加します。\n\n宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            return
+    step_handler = DOCUMENT_CREATION_STEP_HANDLERS.get(step)
+    if step_handler:
+        step_handler(event, session, text)
 
-    # 請求書シート選択ステップ（既存の処理）
-    if step == 'select_invoice_sheet' and text.startswith('シート選択:'):
-        selected_sheet_id = text.replace('シート選択:', '').strip()
-        session_manager.update_session(user_id, {
-            'selected_invoice_sheet_id': selected_sheet_id,
-            'step': 'company_name'
-        })
+# セッションのstateごとのメッセージ処理（handle_existing_userで使用）
+SESSION_STATE_HANDLERS = {
+    'registration': handle_registration,
+    'menu': handle_menu,
+    'document_creation': handle_document_creation,
+}
+
+def submit_generate_document(event, session, progress_text=None):
+    """書類生成をバックグラウンドで開始する（結果はgenerate_document内で送信される）"""
+    user_id = event.source.user_id
+    with _generating_users_lock:
+        if user_id in _generating_users:
+            logger.info("submit_generate_document: 生成中のため重複リクエストをスキップ user_id=%s", user_id)
+            return
+        _generating_users.add(user_id)
+
+    def _on_done(future):
+        with _generating_users_lock:
+            _generating_users.discard(user_id)
+        _log_document_task_error(future)
+
+    # まだreply_tokenを使っていなければ生成処理側で使えるよう引き継ぐ
+    reply_token = current_reply_token(user_id) or ReplyToken(event)
+    # Webhook側で引き続き触られても影響しないよう、セッションはその時点の内容を複製して渡す
+    future = document_executor.submit(generate_document, event, copy.deepcopy(session), progress_text, reply_token)
+    future.add_done_callback(_on_done)
+
+def _log_document_task_error(future):
+    """generate_document内で捕捉されなかった例外をログに残す（Futureに握りつぶされないように）"""
+    error = future.exception()
+    if error:
+        logger.error("generate_document: バックグラウンド処理で未処理の例外: %s", error, exc_info=error)
+
+class ReplyToken:
+    """1回しか使えないreply_tokenを有効期限付きで保持する"""
+
+    def __init__(self, event):
+        self._lock = threading.Lock()
+        self._token = getattr(event, 'reply_token', None)
+        # LINEのイベント発生時刻（ミリ秒）から期限を計算する（再送イベントでは既に古い場合がある）
+        timestamp = getattr(event, 'timestamp', None)
+        issued_at = timestamp / 1000 if timestamp else time.time()
+        self._expires_at = issued_at + REPLY_TOKEN_TTL
+
+    def take(self):
+        """未使用かつ期限内ならトークンを返し、以降は使用済みとする"""
+        with self._lock:
+            token, self._token = self._token, None
+        if token and time.time() < self._expires_at:
+            return token
+        return None
+
+def reply_or_push(user_id, reply_token, messages):
+    """reply_tokenがあればReply APIで送信し、無い・失敗した場合はPush APIで送信"""
+    if reply_token:
         try:
-            print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text="会社名を入力してください。")]
-                    )
-                )
+            line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=messages))
+            return
         except Exception as e:
-            print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
-        return
+            logger.warning("reply_message失敗のためpushで再送: %s", e)
+    line_bot_api.push_message(PushMessageRequest(to=user_id, messages=messages))
 
-    if step == 'company_name':
-        if text == "はい":
-            session_manager.update_session(user_id, {'step': 'client_name'})
-            try:
-                print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="次に宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
-        elif text == "編集する":
-            session_manager.update_session(user_id, {'step': 'edit_company_name'})
-            try:
-                print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="新しい会社名を入力してください。")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
-        else:
-            # デフォルト処理：入力されたテキストを会社名として保存
-            session_manager.update_session(user_id, {
-                'company_name': text,
-                'step': 'client_name'
-            })
-            try:
-                print(f"[DEBUG] handle_document_creation: 会社名保存後 reply_token={event.reply_token}, event={event}")
-                print(f"[DEBUG] handle_document_creation: ApiClient作成前")
-                with ApiClient(configuration) as api_client:
-                    print(f"[DEBUG] handle_document_creation: ApiClient作成後")
-                    print(f"[DEBUG] handle_document_creation: MessagingApi作成前")
-                    line_bot_api = MessagingApi(api_client)
-                    print(f"[DEBUG] handle_document_creation: MessagingApi作成後")
-                    print(f"[DEBUG] handle_document_creation: push_message呼び出し前")
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=f"✅ 会社名を「{text}」に設定しました。\n\n次に宛名（クライアント名）を入力してください。\n例：株式会社○○ ○○様")]
-                        )
-                    )
-                    print(f"[DEBUG] handle_document_creation: push_message呼び出し後")
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
+def generate_document(event, session, progress_text=None, reply_token=None):
+    """書類の生成と送信"""
+    logger.debug("generate_document: 開始")
+    user_id = event.source.user_id
+    doc_type = session.get('document_type')
 
-    elif step == 'client_name':
-        # 新規品目入力の開始時に毎回 items を初期化して、
-        # 以前のセッションの品目が残って合計がズレないようにする
-        session_manager.update_session(user_id, {
-            'client_name': text,
-            'step': 'items',
-            'items': []
-        })
-        try:
-            print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=f"✅ 宛名を「{text}」に設定しました。\n\n次に品目を入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000\n\n最大10件まで入力できます。")]
-                    )
-                )
-        except Exception as e:
-            print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+    # reply_tokenは1回しか使えないため、進行中メッセージと完了メッセージのどちらか先に送る方が使う
+    if reply_token is None:
+        reply_token = ReplyToken(event)
 
-    elif step == 'items':
-        items = session.get('items', [])
-        doc_type = session.get('document_type')
-        
-        # --- 確認フロー追加 ---
-        def build_summary(session):
-            company = session.get('company_name', '')
-            client = session.get('client_name', '')
-            items = session.get('items', [])
-            total = sum(item['amount'] for item in items)
-            item_lines = '\n'.join([f"・{item['name']}（{item['quantity']}個 × {item['price']}円 = {item['amount']}円）" for item in items])
-            summary = f"【会社名】{company}\n【宛名】{client}\n【品目】\n{item_lines}\n【合計金額】{total:,}円"
-            return summary
-        
-        if len(items) >= 10 or text == "完了":
-            if not items:
-                try:
-                    print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="品目が入力されていません。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                return
-            # --- 修正ここから ---
-            if doc_type == 'estimate':
-                # 見積書は従来通り最終確認
-                flex_json = build_rich_text_summary(session)
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text=flex_json)]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                session_manager.update_session(user_id, {'step': 'confirm'})
-                return
-            else:
-                # 請求書は支払い期日を質問
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="✅ 品目の入力が完了しました。\n\n次に支払い期日を入力してください。\n形式：YYYY-MM-DD\n例：2024-01-31")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                session_manager.update_session(user_id, {'step': 'due_date'})
-                return
-        # --- 修正ここまで ---
-                
-        if text == "完了":
-            print(f"[DEBUG] 完了入力時 items={items}")
-            if not items:
-                try:
-                    print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="品目が入力されていません。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                return
-                
-            if doc_type == 'estimate':
-                try:
-                    print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="✅ 品目の入力が完了しました。\n\n書類の生成を開始します...")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                session_manager.update_session(user_id, {'step': 'generate'})
-                generate_document(event, session)
-                return
-            else:
-                try:
-                    print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="✅ 品目の入力が完了しました。\n\n次に支払い期日を入力してください。\n形式：YYYY-MM-DD\n例：2024-01-31")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-                session_manager.update_session(user_id, {'step': 'due_date'})
-                return
-                
-        try:
-            normalized_text = normalize_item_input(text)
-            parts = normalized_text.split(',')
-            if len(parts) == 3:
-                item_name = parts[0].strip()
-                quantity = kanji_num_to_int(parts[1].strip())
-                price = kanji_num_to_int(parts[2].strip())
-                items.append({
-                    'name': item_name,
-                    'price': price,
-                    'quantity': quantity,
-                    'amount': price * quantity
-                })
-                print(f"[DEBUG] Item added: name={item_name}, quantity={quantity}, price={price}, amount={price * quantity}")
-                session_manager.update_session(user_id, {'items': items})
-                total = sum(item['amount'] for item in items)
-                response_text = f"✅ 品目を追加しました：{item_name}\n\n現在の品目数：{len(items)}/10\n合計金額：{total:,}円\n\n続けて品目を入力するか、「完了」と入力してください。"
-                print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text=response_text)]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-            else:
-                print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-                try:
-                    with ApiClient(configuration) as api_client:
-                        line_bot_api = MessagingApi(api_client)
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id,
-                                messages=[TextMessage(text="形式が正しくありません。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000")]
-                            )
-                        )
-                except Exception as e:
-                    print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                    import traceback
-                    traceback.print_exc()
-        except ValueError:
-            print(f"[DEBUG] handle_document_creation: reply_token={event.reply_token}, event={event}")
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="数量と単価は数字で入力してください。\n\n形式：品目名,数量,単価\n例：Webサイト制作,1,100000")]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
-        except Exception as e:
-            print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-            import traceback
-            traceback.print_exc()
+    # Timer.cancel()は実行中のコールバックを止められないため、完了フラグの確認と
+    # 進行中メッセージの送信をロック内で行い、完了通知より後に届かないようにする
+    progress_lock = threading.Lock()
+    progress_finished = threading.Event()
 
-    # 請求書の場合の追加ステップ
-    elif step == 'due_date':
-        try:
-            due_date = datetime.strptime(text, '%Y-%m-%d')
-            session_manager.update_session(user_id, {
-                'due_date': text
-            })
-            # --- ここから修正 ---
-            # 支払い期日入力後、最終確認メッセージを表示
-            flex_json = build_rich_text_summary(session_manager.get_session(user_id))
-            try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=flex_json)]
-                        )
-                    )
-            except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
-            session_manager.update_session(user_id, {'step': 'confirm'})
-            return
-            # --- ここまで修正 ---
-        except ValueError:
+    def send_progress_notice():
+        with progress_lock:
+            if progress_finished.is_set():
+                return
             try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text="日付の形式が正しくありません。\n\n形式：YYYY-MM-DD\n例：2024-01-31")]
-                        )
-                    )
+                reply_or_push(user_id, reply_token.take(), [TextMessage(text=progress_text)])
             except Exception as e:
-                print(f"[ERROR] handle_document_creation: push_message送信時に例外発生: {e}")
-                import traceback
-                traceback.print_exc()
-        return
-
-    # 以降のnotes, email, phone, representative, business_numberのステップはスキップ（請求書の場合）
-
-    # generateステップで書類生成を必ず呼び出す
-    if step == 'generate':
-        print("[DEBUG] handle_document_creation: generate step - 書類生成処理を呼び出します")
-        generate_document(event, session)
-        return
-
-def generate_document(event, session):
-    """書類の生成と送信"""
-    print("[DEBUG] generate_document: 開始")
-    user_id = event.source.user_id
-    doc_type = session.get('document_type')
+                logger.error("generate_document: 進行中メッセージ送信時に例外発生: %s", e)
+
+    # すぐに終わる場合は進行中メッセージを省略し、完了メッセージ1通だけを送る
+    progress_timer = None
+    if progress_text:
+        progress_timer = threading.Timer(DOCUMENT_PROGRESS_NOTICE_DELAY, send_progress_notice)
+        progress_timer.daemon = True
+        progress_timer.start()
+
+    def finish_progress():
+        """進行中メッセージを止める（送信中の場合は送り終わるまで待つ）"""
+        if progress_timer:
+            progress_timer.cancel()
+        with progress_lock:
+            progress_finished.set()
     try:
-        print(f"[DEBUG] generate_document: user_id={user_id}, doc_type={doc_type}")
-        print(f"[DEBUG] generate_document: session={session}")
-        print(f"[DEBUG] generate_document: reply_token={event.reply_token}, event={event}")
+        logger.debug("generate_document: user_id=%s, doc_type=%s", user_id, doc_type)
+        logger.debug("generate_document: session=%s", session)
+        logger.debug("generate_document: reply_token=%s", event.reply_token)
         session['user_id'] = user_id
-        print(f"[DEBUG] generate_document: session={session}")
+        logger.debug("generate_document: session=%s", session)
         
         # Google SheetsとPDFの両方を生成
-        sheet_url, pdf_path, pdf_file_id = document_generator.create_document_with_pdf(session)
-        print(f"[DEBUG] generate_document: sheet_url={sheet_url}")
-        print(f"[DEBUG] generate_document: pdf_path={pdf_path}")
-        print(f"[DEBUG] generate_document: pdf_file_id={pdf_file_id}")
-        
-        # 編集リンクとPDFダウンロードリンクを1つのメッセージにまとめて送信
-        import os
-        pdf_filename = os.path.basename(pdf_path) if pdf_path else None
-        server_url = os.getenv("SERVER_URL", "http://192.168.0.207:5001")
+        sheet_url, pdf_path, pdf_file_id = get_document_generator().create_document_with_pdf(session)
+        logger.debug("generate_document: sheet_url=%s", sheet_url)
+        logger.debug("generate_document: pdf_path=%s", pdf_path)
+        logger.debug("generate_document: pdf_file_id=%s", pdf_file_id)
         
         # 編集されたシートのみのPDFダウンロードリンク
         doc_type = session.get('document_type')
@@ -1877,51 +1453,41 @@ def generate_document(event, session):
             spreadsheet_id = session_manager.get_invoice_spreadsheet_id(user_id)
         
         if spreadsheet_id:
-            edited_sheets_pdf_url = f"{server_url}/download/edited-sheets/{spreadsheet_id}.pdf?user_id={user_id}"
+            edited_sheets_pdf_url = f"{SERVER_URL}/download/edited-sheets/{spreadsheet_id}.pdf?user_id={user_id}"
         else:
-            print(f"[DEBUG] generate_document: spreadsheet_id取得失敗 - doc_type={doc_type}, user_id={user_id}")
+            logger.debug("generate_document: spreadsheet_id取得失敗 - doc_type=%s, user_id=%s", doc_type, user_id)
             edited_sheets_pdf_url = "(編集シートPDFリンク取得失敗 - スプレッドシートIDが見つかりません)"
         
         # 最新の編集済みシートを直接開くリンク（gidも取得して正確なURLにする）
-        latest_sheet_name = document_generator.get_latest_edited_sheet_name(spreadsheet_id, user_id) if spreadsheet_id else None
+        latest_sheet_name = get_document_generator().get_latest_edited_sheet_name(spreadsheet_id, user_id) if spreadsheet_id else None
         sheet_url_with_tab = sheet_url
         if latest_sheet_name:
             # gid取得
+            gid = None
             try:
                 credentials = auth_service.get_credentials(user_id)
                 service = google_sheets_service._get_service(credentials)
-                spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-                gid = None
-                for sheet in spreadsheet['sheets']:
-                    if sheet['properties']['title'] == latest_sheet_name:
-                        gid = sheet['properties']['sheetId']
-                        break
-                import urllib.parse
-                encoded_sheet_name = urllib.parse.quote(latest_sheet_name)
-                if gid is not None:
-                    sheet_url_with_tab = f"{sheet_url}#gid={gid}&range={encoded_sheet_name}!A1"
-                else:
-                    sheet_url_with_tab = f"{sheet_url}#range={encoded_sheet_name}!A1"
+                # シートが見つからない場合は例外となり、gidなしのURLにフォールバックする
+                gid = google_sheets_service.get_sheet_id_by_name(service, spreadsheet_id, latest_sheet_name)
             except Exception as e:
-                print(f"[WARNING] 最新シートgid取得失敗: {e}")
-                import urllib.parse
-                encoded_sheet_name = urllib.parse.quote(latest_sheet_name)
-                sheet_url_with_tab = f"{sheet_url}#range={encoded_sheet_name}!A1"
+                logger.warning("最新シートgid取得失敗: %s", e)
+            range_fragment = f"range={quote(latest_sheet_name)}!A1"
+            if gid is not None:
+                sheet_url_with_tab = f"{sheet_url}#gid={gid}&{range_fragment}"
+            else:
+                sheet_url_with_tab = f"{sheet_url}#{range_fragment}"
         
-        # メッセージテキスト生成（全体PDFダウンロードは削除）
-        message_text = f"✅ {'見積書' if doc_type == 'estimate' else '請求書'}を作成しました！\n\n📝 編集リンク：\n{sheet_url_with_tab}\n\n📄 PDFダウンロード：\n{edited_sheets_pdf_url}"
+        # 完了通知・編集リンク・PDFリンクを1回のAPI呼び出しでまとめて送信（全体PDFダウンロードは削除）
+        result_messages = [
+            TextMessage(text=f"✅ {'見積書' if doc_type == 'estimate' else '請求書'}を作成しました！"),
+            TextMessage(text=f"📝 編集リンク：\n{sheet_url_with_tab}"),
+            TextMessage(text=f"📄 PDFダウンロード：\n{edited_sheets_pdf_url}")
+        ]
+        finish_progress()
         try:
-            print(f"[DEBUG] generate_document: reply_token={event.reply_token}, event={event}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=message_text)]
-                    )
-                )
+            reply_or_push(user_id, reply_token.take(), result_messages)
         except Exception as e:
-            print(f"[ERROR] generate_document: push_message送信時に例外発生: {e}")
+            logger.error("generate_document: push_message送信時に例外発生: %s", e)
         
         # PDFファイルの一時ファイル削除
         # if pdf_path and os.path.exists(pdf_path):
@@ -1935,36 +1501,27 @@ def generate_document(event, session):
         
         session_manager.update_session(user_id, {'state': 'menu'})
     except Exception as e:
-        print(f"[ERROR] generate_document: {e}")
-        import traceback
-        traceback.print_exc()
-        logger.error(f"Document generation error: {e}")
+        logger.exception("Document generation error: %s", e)
+        finish_progress()
         try:
-            print(f"[DEBUG] generate_document: push_message error fallback user_id={user_id}")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text="❌ 書類の作成中にエラーが発生しました。\n\nしばらく時間をおいて再度お試しください。")]
-                    )
-                )
+            logger.debug("generate_document: push_message error fallback user_id=%s", user_id)
+            reply_or_push(user_id, reply_token.take(), [TextMessage(text="❌ 書類の作成中にエラーが発生しました。\n\nしばらく時間をおいて再度お試しください。")])
         except Exception as push_e:
-            print(f"[ERROR] generate_document: push_message送信時に例外発生: {push_e}")
+            logger.error("generate_document: push_message送信時に例外発生: %s", push_e)
 
 def normalize_item_input(text):
-    # 全角カンマ→半角カンマ
-    text = text.replace('、', ',')
-    # 全角数字→半角数字
-    text = text.translate(str.maketrans('０１２３４５６７８９', '0123456789'))
-    # 全角スペース→半角スペース
-    text = text.replace('　', ' ')
+    # 読点→カンマ、全角数字→半角数字、全角スペース→半角スペースを1回の変換で行う
+    text = text.translate(ITEM_INPUT_TRANSLATION)
     # 区切り文字（カンマ、スペース、タブ）をカンマに統一
-    text = re.sub(r'[\s,]+', ',', text.strip())
-    return text
+    return ITEM_SEPARATOR_PATTERN.sub(',', text.strip())
 
 def kanji_num_to_int(s):
     s = s.strip()
+    # ほとんどの入力は半角数字のみなので、まずそのまま変換を試す
+    try:
+        return int(s)
+    except ValueError:
+        pass
     # 万・千の単位を数値化
     if s.endswith('万'):
         try:
@@ -1996,7 +1553,7 @@ def download_pdf(filename):
         try:
             os.remove(pdf_path)
         except Exception as e:
-            print(f"[WARNING] PDFファイル削除失敗: {e}")
+            logger.warning("PDFファイル削除失敗: %s", e)
         return response
 
     return send_file(pdf_path, as_attachment=True, mimetype='application/pdf', download_name=filename)
@@ -2004,97 +1561,127 @@ def download_pdf(filename):
 @app.route('/download/edited-sheets/<spreadsheet_id>.pdf')
 def download_edited_sheets_pdf(spreadsheet_id):
     """編集されたシートのみのPDFをダウンロード"""
-    import os
-    import tempfile
-    
     # Google認証情報を取得
     user_id = request.args.get('user_id')
     if not user_id:
         return 'user_idが必要です', 400
     
-    auth_service = AuthService()
     credentials = auth_service.get_credentials(user_id)
     if not credentials:
         return 'Google認証が必要です', 401
 
+    download_name = f'edited_sheets_{spreadsheet_id}.pdf'
     try:
+        # 最終更新日時が取れた場合だけキャッシュを使う（取れない場合は毎回生成する）
+        modified_time = google_sheets_service.get_modified_time(credentials, spreadsheet_id)
+        cache_key = (user_id, spreadsheet_id, modified_time)
+        if modified_time:
+            with _edited_sheets_pdf_cache_lock:
+                entry = _edited_sheets_pdf_cache.get(cache_key)
+            if entry and time.monotonic() - entry[0] < EDITED_SHEETS_PDF_CACHE_TTL:
+                return send_file(io.BytesIO(entry[1]), as_attachment=True, mimetype='application/pdf', download_name=download_name)
+
         # 編集されたシートのみのPDFを生成
-        result = pdf_generator.create_edited_sheets_pdf(
+        result = get_pdf_generator().create_edited_sheets_pdf(
             google_sheets_service, credentials, spreadsheet_id
         )
         
         if not result:
             return '編集されたシートが見つかりません', 404
 
-        @after_this_request
-        def remove_file(response):
+        # 一時ファイルは読み込んだらすぐ削除する
+        try:
+            with open(result, 'rb') as f:
+                pdf_bytes = f.read()
+        finally:
             try:
                 os.remove(result)
             except Exception as e:
-                print(f"[WARNING] PDFファイル削除失敗: {e}")
-            return response
+                logger.warning("PDFファイル削除失敗: %s", e)
+
+        if modified_time:
+            now = time.monotonic()
+            with _edited_sheets_pdf_cache_lock:
+                _edited_sheets_pdf_cache.pop(cache_key, None)
+                _edited_sheets_pdf_cache[cache_key] = (now, pdf_bytes)
+                # 期限切れと上限超過分を古い順に破棄
+                while _edited_sheets_pdf_cache:
+                    cached_at, _ = next(iter(_edited_sheets_pdf_cache.values()))
+                    if now - cached_at < EDITED_SHEETS_PDF_CACHE_TTL and len(_edited_sheets_pdf_cache) <= EDITED_SHEETS_PDF_CACHE_MAX_ENTRIES:
+                        break
+                    _edited_sheets_pdf_cache.popitem(last=False)
 
-        return send_file(result, as_attachment=True, mimetype='application/pdf', download_name=f'edited_sheets_{spreadsheet_id}.pdf')
+        return send_file(io.BytesIO(pdf_bytes), as_attachment=True, mimetype='application/pdf', download_name=download_name)
         
     except Exception as e:
-        logger.error(f"Edited sheets PDF download error: {e}")
-        print(f"[ERROR] download_edited_sheets_pdf: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Edited sheets PDF download error: %s", e)
         return f'PDF生成に失敗しました: {str(e)}', 500
 
 @app.route('/download/pdf/<spreadsheet_id>/<sheet_name>.pdf')
 def download_pdf_sheet(spreadsheet_id, sheet_name):
-    import os
-    from services.google_sheets_service import GoogleSheetsService
-    from services.auth_service import AuthService
-    import requests
-
     # Google認証情報を取得
     user_id = request.args.get('user_id')
     if not user_id:
         return 'user_idが必要です', 400
-    auth_service = AuthService()
     credentials = auth_service.get_credentials(user_id)
     if not credentials:
         return 'Google認証が必要です', 401
 
-    # gid取得
-    sheets_service = GoogleSheetsService()
-    service = sheets_service._get_service(credentials)
-    spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    gid = None
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == sheet_name:
-            gid = sheet['properties']['sheetId']
-            break
-    if gid is None:
-        return '指定シートが見つかりません', 404
-
-    # Google Sheets export URL組み立て
-    export_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=pdf&gid={gid}&single=true&portrait=true&size=A4&fitw=true&top_margin=0.5&bottom_margin=0.5&left_margin=0.5&right_margin=0.5"
+    service = google_sheets_service._get_service(credentials)
+    # 認証付きでPDF取得（ユーザーごとのAuthorizedSessionを再利用）
+    # エクスポートはユーザー自身の認証情報で行うため、閲覧権限の確認はGoogle側で行われる
+    authed_session = get_authorized_session(credentials)
+    pdf_response = None
+    # キャッシュ済みのgidが古い（シート名変更・削除など）とエクスポートに失敗するため、
+    # 失敗時はキャッシュを捨ててgidを引き直し、1回だけ再試行する
+    for use_cache in (True, False):
+        # gid取得
+        try:
+            gid = google_sheets_service.get_sheet_id_by_name(service, spreadsheet_id, sheet_name, use_cache=use_cache)
+        except Exception:
+            return '指定シートが見つかりません', 404
 
-    # 認証付きでPDF取得
-    authed_session = requests.Session()
-    authed_session.auth = credentials
-    response = authed_session.get(export_url)
-    if response.status_code != 200:
+        # Google Sheets export URL組み立て
+        export_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=pdf&gid={gid}&single=true&portrait=true&size=A4&fitw=true&top_margin=0.5&bottom_margin=0.5&left_margin=0.5&right_margin=0.5"
+        try:
+            pdf_response = authed_session.get(export_url, stream=True, timeout=PDF_EXPORT_TIMEOUT)
+            pdf_response.raise_for_status()
+            break
+        except requests.HTTPError:
+            logger.warning("download_pdf_sheet: PDFエクスポート失敗 status=%s gid=%s", pdf_response.status_code, gid)
+            pdf_response.close()
+            pdf_response = None
+            invalidate_sheet_gids(spreadsheet_id)
+        except requests.RequestException as e:
+            # 接続エラー・タイムアウトはgidの問題ではないので再試行しない
+            logger.warning("download_pdf_sheet: PDFエクスポート通信エラー: %s", e)
+            return 'PDF取得に失敗しました', 500
+    if pdf_response is None:
         return 'PDF取得に失敗しました', 500
 
-    # 一時ファイルに保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-        tmp.write(response.content)
-        tmp_path = tmp.name
-
-    @after_this_request
-    def remove_file(response):
+    # 一時ファイルを経由せず、Googleからの応答をそのままクライアントへ中継する
+    def generate():
         try:
-            os.remove(tmp_path)
-        except Exception as e:
-            print(f"[WARNING] PDFファイル削除失敗: {e}")
-        return response
-
-    return send_file(tmp_path, as_attachment=True, mimetype='application/pdf', download_name=f'{sheet_name}.pdf')
+            for chunk in pdf_response.iter_content(chunk_size=PDF_STREAM_CHUNK_SIZE):
+                yield chunk
+        except requests.RequestException as e:
+            # ヘッダー送信後はエラー応答に切り替えられないため、例外を送出して接続を切り、
+            # 途中までのPDFが正常に完了したように見えないようにする
+            logger.exception("download_pdf_sheet: PDF中継中に通信エラー: %s", e)
+            raise
+        finally:
+            pdf_response.close()
+
+    headers = {'Content-Disposition': f"attachment; filename*=UTF-8''{quote(sheet_name)}.pdf"}
+    # サイズが分かる場合は伝え、クライアント側でも途中切断を検知できるようにする
+    content_length = pdf_response.headers.get('Content-Length')
+    if content_length and not pdf_response.headers.get('Content-Encoding'):
+        headers['Content-Length'] = content_length
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/pdf',
+        headers=headers
+    )
 
 @app.route('/test/restriction/<line_user_id>')
 def test_restriction_check(line_user_id):
@@ -2126,9 +1713,8 @@ def health_check_restriction():
                 "restriction_check_enabled": False
             }
         
-        # 簡単な接続テスト
-        import psycopg2
-        with psycopg2.connect(database_url) as conn:
+        # 簡単な接続テスト（SessionManagerの接続プールを使い、プローブのたびに接続を張らない）
+        with session_manager.pg_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT 1")
                 result = cur.fetchone()
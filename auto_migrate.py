@@ -63,10 +63,8 @@ def check_and_migrate():
         conn.close()
 
     except Exception as e:
-        logger.error(f"❌ Migration error: {e}")
-        # エラーが発生してもアプリケーションは起動を続ける
-        import traceback
-        traceback.print_exc()
+        # エラーが発生してもアプリケーションは起動を続ける（トレースバックはロガー経由で出力）
+        logger.exception("❌ Migration error: %s", e)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
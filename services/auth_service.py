@@ -1,62 +1,59 @@
 import os
 import json
+import time
 import logging
-import traceback
+import threading
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google.auth.exceptions import RefreshError
+import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
 from flask import url_for, request
+from .session_manager import get_session_manager
 
 logger = logging.getLogger(__name__)
 
+# ユーザーごとの認証情報キャッシュ（user_id -> (キャッシュ時刻, Credentials)）
+# AuthServiceは複数箇所で生成されるため、モジュール単位で共有する
+# 再訪しないユーザーの分が溜まり続けないよう、TTLと件数の上限を設ける
+CREDENTIALS_CACHE_TTL = 300
+CREDENTIALS_CACHE_MAX_ENTRIES = 5000
+# TTLは一律なので挿入順＝古い順として先頭から捨てられる
+_credentials_cache = OrderedDict()
+_credentials_cache_lock = threading.Lock()
+
+# ユーザーごとの認証URLキャッシュ（user_id -> (生成時刻, URL)）
+# stateにuser_idをそのまま使うため、クライアント設定が同じならURLは変わらない
+# 未認証のまま離脱したユーザーの分が溜まり続けないよう、TTLと件数の上限を設ける
+AUTH_URL_CACHE_TTL = 300
+AUTH_URL_CACHE_MAX_ENTRIES = 10000
+# TTLは一律なので挿入順＝古い順として先頭から捨てられる
+_auth_url_cache = OrderedDict()
+_auth_url_cache_lock = threading.Lock()
+
+# トークン更新（oauth2.googleapis.com）用のHTTPセッション
+# Request()を毎回作るとその都度requests.Sessionが作られTLS接続を張り直すため、プロセス内で共有する
+_token_refresh_session = requests.Session()
+_token_refresh_session.mount('https://', HTTPAdapter(pool_maxsize=20))
+_token_refresh_request = Request(session=_token_refresh_session)
+
 class AuthService:
     """Google OAuth認証管理クラス"""
     
     def __init__(self):
-        # 環境変数のデバッグ
-        print(f"[DEBUG] GOOGLE_CLIENT_SECRETS_JSON exists: {os.getenv('GOOGLE_CLIENT_SECRETS_JSON') is not None}")
-        print(f"[DEBUG] GOOGLE_CLIENT_SECRETS_FILE: {os.getenv('GOOGLE_CLIENT_SECRETS_FILE')}")
-        print(f"[DEBUG] GOOGLE_CLIENT_SECRETS_JSON value: {os.getenv('GOOGLE_CLIENT_SECRETS_JSON')[:100] if os.getenv('GOOGLE_CLIENT_SECRETS_JSON') else 'None'}...")
-        print(f"[DEBUG] All environment variables: {[k for k, v in os.environ.items() if 'GOOGLE' in k or 'SERVER' in k]}")
-        
-        # 環境変数からJSON文字列を取得してファイルとして保存
+        # 環境変数からJSON文字列を取得（ファイルには書き出さずメモリ上で保持する）
         client_secrets_env = os.getenv('GOOGLE_CLIENT_SECRETS_JSON')
         
         # 環境変数が設定されていない場合は警告を表示（エラーにはしない）
         if not client_secrets_env:
-            print("[WARNING] GOOGLE_CLIENT_SECRETS_JSON environment variable is not set")
-            print("[WARNING] Google OAuth features will be disabled")
+            logger.warning("GOOGLE_CLIENT_SECRETS_JSON environment variable is not set. Google OAuth features will be disabled")
             self.google_oauth_enabled = False
             # 早期リターンを削除し、後続の処理を実行
         else:
             self.google_oauth_enabled = True
         
-        # client_secrets_envが設定されている場合のみファイル作成処理を実行
-        if client_secrets_env:
-            try:
-                # 絶対パスでclient_secrets.jsonファイルを指定
-                base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                client_secrets_path = os.path.join(base_dir, 'client_secrets.json')
-                
-                # JSON文字列をファイルとして保存
-                with open(client_secrets_path, 'w') as f:
-                    f.write(client_secrets_env)
-                print(f"[DEBUG] client_secrets.json created at {client_secrets_path}")
-                
-                self.client_secrets_file = client_secrets_path
-            except Exception as e:
-                print(f"[ERROR] Failed to create client_secrets.json: {e}")
-                # フォールバック: デフォルトパスを使用
-                base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-                self.client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-        else:
-            # 絶対パスでclient_secrets.jsonファイルを指定
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-            self.client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-        
         self.scopes = [
             'https://www.googleapis.com/auth/spreadsheets',
             'https://www.googleapis.com/auth/drive',
@@ -66,87 +63,65 @@ class AuthService:
         # リダイレクトURIの設定（新しいプロジェクトのURLに合わせる）
         default_redirect_uri = os.getenv('SERVER_URL', 'http://localhost:5000') + '/auth/callback'
         self.redirect_uri = os.getenv('GOOGLE_REDIRECT_URI', default_redirect_uri)
-        print(f"[DEBUG] Google OAuth redirect_uri: {self.redirect_uri}")
+        logger.debug("Google OAuth redirect_uri: %s", self.redirect_uri)
         
-        # client_secrets_envが設定されている場合のみファイルチェックとフロー設定を実行
+        # client_secrets_envが設定されている場合のみクライアント設定の解析とフロー設定を実行
         if client_secrets_env:
-            # ファイルの存在確認と内容チェック
-            print(f"[DEBUG] client_secrets_file path: {self.client_secrets_file}")
-            if os.path.exists(self.client_secrets_file):
-                try:
-                    with open(self.client_secrets_file, 'r') as f:
-                        content = f.read()
-                        print(f"[DEBUG] client_secrets.json content length: {len(content)}")
-                        if len(content.strip()) == 0:
-                            raise Exception("client_secrets.json is empty")
-                        # JSONとして解析できるかテスト
-                        json.loads(content)
-                        print("[DEBUG] client_secrets.json is valid JSON")
-                except Exception as e:
-                    print(f"[ERROR] client_secrets.json validation failed: {e}")
-                    raise
-            else:
-                print(f"[ERROR] client_secrets.json file not found at: {self.client_secrets_file}")
-                raise FileNotFoundError(f"client_secrets.json not found at {self.client_secrets_file}")
+            try:
+                if len(client_secrets_env.strip()) == 0:
+                    raise Exception("GOOGLE_CLIENT_SECRETS_JSON is empty")
+                self.client_config = json.loads(client_secrets_env)
+            except Exception as e:
+                logger.error("GOOGLE_CLIENT_SECRETS_JSON validation failed: %s", e)
+                raise
             
             # 認証フローの設定
-            self.flow = Flow.from_client_secrets_file(
-                self.client_secrets_file,
-                scopes=self.scopes,
-                redirect_uri=self.redirect_uri
-            )
+            self.flow = self._create_flow()
         else:
             # Google OAuthが無効な場合の処理
-            print("[DEBUG] Google OAuth is disabled - skipping flow setup")
+            logger.debug("Google OAuth is disabled - skipping flow setup")
+            self.client_config = None
             self.flow = None
     
+    def _create_flow(self):
+        """メモリ上のクライアント設定から認証フローを作成"""
+        return Flow.from_client_config(
+            self.client_config,
+            scopes=self.scopes,
+            redirect_uri=self.redirect_uri
+        )
+    
     def get_auth_url(self, user_id):
         """認証URLを生成"""
         if not hasattr(self, 'google_oauth_enabled') or not self.google_oauth_enabled:
-            print("[DEBUG] Google OAuth is disabled")
+            logger.debug("Google OAuth is disabled")
             return None
+        with _auth_url_cache_lock:
+            entry = _auth_url_cache.get(user_id)
+        if entry and time.monotonic() - entry[0] < AUTH_URL_CACHE_TTL:
+            return entry[1]
         try:
-            print(f"[DEBUG] get_auth_url: user_id={user_id}")
-            print(f"[DEBUG] get_auth_url: redirect_uri={self.redirect_uri}")
-            # 環境変数からJSON文字列を取得してファイルとして保存
-            client_secrets_env = os.getenv('GOOGLE_CLIENT_SECRETS_JSON')
-            if client_secrets_env:
-                try:
-                    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                    client_secrets_path = os.path.join(base_dir, 'client_secrets.json')
-                    
-                    with open(client_secrets_path, 'w') as f:
-                        f.write(client_secrets_env)
-                    
-                    client_secrets_file = client_secrets_path
-                except Exception as e:
-                    print(f"[ERROR] Failed to create client_secrets.json: {e}")
-                    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                    default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-                    client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-            else:
-                base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-                client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-            
-            flow = Flow.from_client_secrets_file(
-                client_secrets_file,
-                scopes=self.scopes,
-                redirect_uri=self.redirect_uri
-            )
+            flow = self._create_flow()
             auth_url, _ = flow.authorization_url(
                 access_type='offline',
                 include_granted_scopes='true',
                 prompt='consent',
                 state=user_id  # stateパラメータとしてuser_idを渡す
             )
-            print(f"[DEBUG] get_auth_url: access_type=offline, prompt=consent")
-            print(f"[DEBUG] get_auth_url: auth_url={auth_url}")
-            logger.info(f"Auth URL generated for user: {user_id}")
+            logger.info("Auth URL generated for user: %s", user_id)
+            now = time.monotonic()
+            with _auth_url_cache_lock:
+                _auth_url_cache.pop(user_id, None)
+                _auth_url_cache[user_id] = (now, auth_url)
+                # 期限切れと上限超過分を古い順に破棄
+                while _auth_url_cache:
+                    cached_at, _ = next(iter(_auth_url_cache.values()))
+                    if now - cached_at < AUTH_URL_CACHE_TTL and len(_auth_url_cache) <= AUTH_URL_CACHE_MAX_ENTRIES:
+                        break
+                    _auth_url_cache.popitem(last=False)
             return auth_url
         except Exception as e:
-            print(f"[DEBUG] get_auth_url: error={e}")
-            logger.error(f"Auth URL generation error: {e}")
+            logger.error("Auth URL generation error: %s", e)
             return None
     
     def handle_callback(self, code, state):
@@ -154,39 +129,11 @@ class AuthService:
         if not hasattr(self, 'google_oauth_enabled') or not self.google_oauth_enabled:
             return False
         try:
-            print(f"[DEBUG] handle_callback: code={code[:20] if code else 'None'}, state={state}")
+            logger.debug("handle_callback: state=%s", state)
             # コールバック時も新しいFlowインスタンスを作成し、stateを復元
-            # 環境変数からJSON文字列を取得してファイルとして保存
-            client_secrets_env = os.getenv('GOOGLE_CLIENT_SECRETS_JSON')
-            if client_secrets_env:
-                try:
-                    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                    client_secrets_path = os.path.join(base_dir, 'client_secrets.json')
-                    
-                    with open(client_secrets_path, 'w') as f:
-                        f.write(client_secrets_env)
-                    
-                    client_secrets_file = client_secrets_path
-                except Exception as e:
-                    print(f"[ERROR] Failed to create client_secrets.json: {e}")
-                    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                    default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-                    client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-            else:
-                base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                default_client_secrets = os.path.join(base_dir, 'client_secrets.json')
-                client_secrets_file = os.getenv('GOOGLE_CLIENT_SECRETS_FILE', default_client_secrets)
-            
-            flow = Flow.from_client_secrets_file(
-                client_secrets_file,
-                scopes=self.scopes,
-                redirect_uri=self.redirect_uri
-            )
-            print(f"[DEBUG] handle_callback: トークン取得開始 - code={code[:20]}...")
+            flow = self._create_flow()
             flow.fetch_token(code=code)
-            print(f"[DEBUG] handle_callback: トークン取得成功")
             credentials = flow.credentials
-            print(f"[DEBUG] handle_callback: credentials.refresh_token={credentials.refresh_token}")
 
             # refresh_tokenが取得できていなければエラー
             if not credentials.refresh_token:
@@ -204,44 +151,54 @@ class AuthService:
                 'client_secret': credentials.client_secret,
                 'scopes': credentials.scopes
             }
-            print(f"[DEBUG] handle_callback: token_info={token_info}")
-            print(f"[DEBUG] handle_callback: refresh_token length={len(credentials.refresh_token) if credentials.refresh_token else 0}")
 
             # セッション管理に保存
-            from .session_manager import SessionManager
-            session_manager = SessionManager()
+            session_manager = get_session_manager()
             session_manager.save_google_token(user_id, json.dumps(token_info))
-
-            # 保存直後に再取得してprintデバッグ
-            saved_token = session_manager.get_google_token(user_id)
-            print(f"[DEBUG] handle_callback: save直後 get_google_token({user_id})={saved_token}")
-
-            logger.info(f"Authentication completed for user: {user_id}")
+            self.invalidate_credentials(user_id)
+            with _auth_url_cache_lock:
+                _auth_url_cache.pop(user_id, None)
+            logger.info("Authentication completed for user: %s", user_id)
             return True
 
         except Exception as e:
-            print(f"[ERROR] handle_callback: {e}")
-            traceback.print_exc()
-            logger.error(f"Auth callback error: {e}")
+            logger.exception("Auth callback error: %s", e)
             return False
     
+    def _get_cached_credentials(self, user_id):
+        """キャッシュ済みの有効な認証情報を取得（期限切れならNone）"""
+        with _credentials_cache_lock:
+            entry = _credentials_cache.get(user_id)
+        if not entry:
+            return None
+        cached_at, credentials = entry
+        if time.monotonic() - cached_at > CREDENTIALS_CACHE_TTL or not credentials.valid:
+            self.invalidate_credentials(user_id)
+            return None
+        return credentials
+
+    def invalidate_credentials(self, user_id):
+        """認証情報キャッシュを破棄（再認証時やGoogleから401が返った場合）"""
+        with _credentials_cache_lock:
+            _credentials_cache.pop(user_id, None)
+
     def get_credentials(self, user_id):
         """ユーザーの認証情報を取得"""
+        cached = self._get_cached_credentials(user_id)
+        if cached:
+            return cached
         try:
-            from .session_manager import SessionManager
-            session_manager = SessionManager()
+            session_manager = get_session_manager()
 
             token_json = session_manager.get_google_token(user_id)
-            print(f"[DEBUG] get_credentials: token_json={token_json}")
             if not token_json:
-                logger.error(f"No google token found for user: {user_id}")
+                logger.error("No google token found for user: %s", user_id)
                 return None
 
             try:
                 token_info = json.loads(token_json)
             except json.JSONDecodeError as e:
-                print(f"[ERROR] get_credentials: JSON decode error for user: {user_id}, error: {e}")
-                logger.error(f"Invalid token JSON for user: {user_id}, error: {e}")
+                logger.error("Invalid token JSON for user: %s, error: %s", user_id, e)
                 # 無効なJSONの場合はトークンを削除
                 session_manager.save_google_token(user_id, None)
                 return None
@@ -250,8 +207,7 @@ class AuthService:
             required_fields = ['token', 'refresh_token', 'token_uri', 'client_id', 'client_secret', 'scopes']
             for field in required_fields:
                 if field not in token_info:
-                    print(f"[ERROR] get_credentials: Missing field '{field}' in token_info for user: {user_id}")
-                    logger.error(f"Missing field '{field}' in token_info for user: {user_id}")
+                    logger.error("Missing field '%s' in token_info for user: %s", field, user_id)
                     session_manager.save_google_token(user_id, None)
                     return None
 
@@ -263,21 +219,17 @@ class AuthService:
                 client_secret=token_info['client_secret'],
                 scopes=token_info['scopes']
             )
-            print(f"[DEBUG] get_credentials: credentials.refresh_token={credentials.refresh_token}")
 
             # refresh_tokenがNoneの場合はエラー
             if not credentials.refresh_token:
-                logger.error(f"refresh_token is None for user: {user_id}")
+                logger.error("refresh_token is None for user: %s", user_id)
                 return None
 
             # トークンの有効期限をチェック
-            print(f"[DEBUG] get_credentials: credentials.expired={credentials.expired}, refresh_token exists={credentials.refresh_token is not None}")
-            print(f"[DEBUG] get_credentials: token expiry info - valid={credentials.valid}, expired={credentials.expired}")
             if credentials.expired and credentials.refresh_token:
                 try:
-                    print(f"[DEBUG] get_credentials: トークン更新開始 user_id={user_id}")
-                    credentials.refresh(Request())
-                    print(f"[DEBUG] get_credentials: トークン更新成功 user_id={user_id}")
+                    credentials.refresh(_token_refresh_request)
+                    logger.debug("get_credentials: トークン更新成功 user_id=%s", user_id)
 
                     # 更新されたトークンを保存
                     updated_token_info = {
@@ -289,27 +241,30 @@ class AuthService:
                         'scopes': credentials.scopes
                     }
                     session_manager.save_google_token(user_id, json.dumps(updated_token_info))
-                    print(f"[DEBUG] get_credentials: 更新されたトークンを保存完了 user_id={user_id}")
 
                 except RefreshError as e:
-                    print(f"[ERROR] get_credentials: RefreshError for user: {user_id}, error: {e}")
-                    print(f"[ERROR] get_credentials: RefreshError details - error_type={type(e).__name__}, error_message={str(e)}")
-                    logger.error(f"Token refresh failed for user: {user_id}, error: {e}")
+                    logger.error("Token refresh failed for user: %s, error: %s", user_id, e)
                     # トークンが無効になった場合は削除
                     session_manager.save_google_token(user_id, None)
-                    print(f"[DEBUG] get_credentials: 無効なトークンを削除 user_id={user_id}")
                     return None
                 except Exception as e:
-                    print(f"[ERROR] get_credentials: トークン更新で予期しないエラー user_id={user_id}, error: {e}")
-                    logger.error(f"Unexpected error during token refresh for user: {user_id}, error: {e}")
+                    logger.error("Unexpected error during token refresh for user: %s, error: %s", user_id, e)
                     return None
 
+            now = time.monotonic()
+            with _credentials_cache_lock:
+                _credentials_cache.pop(user_id, None)
+                _credentials_cache[user_id] = (now, credentials)
+                # 期限切れと上限超過分を古い順に破棄
+                while _credentials_cache:
+                    cached_at, _ = next(iter(_credentials_cache.values()))
+                    if now - cached_at < CREDENTIALS_CACHE_TTL and len(_credentials_cache) <= CREDENTIALS_CACHE_MAX_ENTRIES:
+                        break
+                    _credentials_cache.popitem(last=False)
             return credentials
 
         except Exception as e:
-            print(f"[ERROR] get_credentials: {e}")
-            traceback.print_exc()
-            logger.error(f"Credentials retrieval error: {e}")
+            logger.exception("Credentials retrieval error: %s", e)
             return None
     
     def is_authenticated(self, user_id):
@@ -319,14 +274,13 @@ class AuthService:
             return credentials is not None
             
         except Exception as e:
-            logger.error(f"Authentication check error: {e}")
+            logger.error("Authentication check error: %s", e)
             return False
     
     def check_token_status(self, user_id):
         """トークンの状態を詳細にチェック"""
         try:
-            from .session_manager import SessionManager
-            session_manager = SessionManager()
+            session_manager = get_session_manager()
             
             token_json = session_manager.get_google_token(user_id)
             if not token_json:
@@ -363,13 +317,13 @@ class AuthService:
                 pass
             
             # トークンを削除
-            from .session_manager import SessionManager
-            session_manager = SessionManager()
+            session_manager = get_session_manager()
             session_manager.save_google_token(user_id, None)
+            self.invalidate_credentials(user_id)
             
-            logger.info(f"Access revoked for user: {user_id}")
+            logger.info("Access revoked for user: %s", user_id)
             return True
             
         except Exception as e:
-            logger.error(f"Access revocation error: {e}")
+            logger.error("Access revocation error: %s", e)
             return False 
\ No newline at end of file
@@ -0,0 +1,60 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreakerError(Exception):
+    """サーキットが開いているため呼び出しを打ち切った"""
+
+class CircuitBreaker:
+    """外部API呼び出し用の簡易サーキットブレーカー
+
+    連続でfail_max回失敗するとreset_timeout秒の間は呼び出しを行わずに
+    CircuitBreakerErrorを送出する。経過後は1回だけ試行し、成功すれば復帰する。
+    """
+
+    def __init__(self, name, fail_max=5, reset_timeout=30, is_failure=None):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        # 例外を障害として数えるかどうか（4xxなど呼び出し側の誤りは除外したい場合に指定）
+        self.is_failure = is_failure or (lambda e: True)
+        self._lock = threading.Lock()
+        self._fail_count = 0
+        self._opened_at = None
+
+    def call(self, func, *args, **kwargs):
+        """サーキットの状態を確認してfuncを呼び出す"""
+        with self._lock:
+            if self._opened_at is not None:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitBreakerError(f"{self.name}: circuit open")
+                # 試行中に他スレッドが殺到しないよう、次の判定までは開いたままとして扱う
+                self._opened_at = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self._record_failure()
+            else:
+                # 相手は応答している（呼び出し側の誤り）ので、試行中でもサーキットは閉じる
+                self._record_success()
+            raise
+        self._record_success()
+        return result
+
+    def _record_failure(self):
+        with self._lock:
+            self._fail_count += 1
+            if self._fail_count >= self.fail_max:
+                if self._opened_at is None:
+                    logger.warning("%s: circuit opened after %s failures", self.name, self._fail_count)
+                self._opened_at = time.monotonic()
+
+    def _record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("%s: circuit closed", self.name)
+            self._fail_count = 0
+            self._opened_at = None
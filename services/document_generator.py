@@ -2,9 +2,8 @@ import logging
 from datetime import datetime
 from .auth_service import AuthService
 from .google_sheets_service import GoogleSheetsService
-from .session_manager import SessionManager
+from .session_manager import get_session_manager
 from .pdf_generator import PDFGenerator
-import traceback
 import io
 from googleapiclient.http import MediaFileUpload
 
@@ -13,21 +12,20 @@ logger = logging.getLogger(__name__)
 class DocumentGenerator:
     """書類生成統合管理クラス"""
     
-    def __init__(self):
-        self.auth_service = AuthService()
-        self.sheets_service = GoogleSheetsService()
-        self.session_manager = SessionManager()
-        self.pdf_generator = PDFGenerator()
+    def __init__(self, auth_service=None, sheets_service=None, pdf_generator=None):
+        # 呼び出し側で生成済みのサービスがあれば共有し、二重に初期化しない
+        self.auth_service = auth_service or AuthService()
+        self.sheets_service = sheets_service or GoogleSheetsService()
+        self.session_manager = get_session_manager()
+        self.pdf_generator = pdf_generator or PDFGenerator()
     
     def create_document(self, session_data):
         """書類を作成してリンクを返す"""
         try:
             user_id = session_data.get('user_id')
             document_type = session_data.get('document_type', 'invoice')
-            print(f"[DEBUG] create_document: user_id={user_id}, document_type={document_type}")
-            print(f"[DEBUG] create_document: is_authenticated={self.auth_service.is_authenticated(user_id)}")
+            logger.debug("create_document: user_id=%s, document_type=%s", user_id, document_type)
             credentials = self.auth_service.get_credentials(user_id)
-            print(f"[DEBUG] create_document: credentials={credentials}")
             if not credentials:
                 raise Exception("Google認証が必要です")
             # 相手先会社名を取得してファイル名に含める
@@ -35,20 +33,18 @@ class DocumentGenerator:
             spreadsheet_id = self.sheets_service.copy_template(
                 credentials, user_id, document_type, client_name=client_name
             )
-            print(f"[DEBUG] create_document: spreadsheet_id={spreadsheet_id}")
+            logger.debug("create_document: spreadsheet_id=%s", spreadsheet_id)
             document_data = self._prepare_document_data(session_data)
-            print(f"[DEBUG] create_document: document_data={document_data}")
+            logger.debug("create_document: document_data=%s", document_data)
             self.sheets_service.update_values(credentials, spreadsheet_id, document_data)
             # フォーマットは一時的に無効化（エラー回避のため）
             # self.sheets_service.format_document(credentials, spreadsheet_id, document_type)
             shareable_link = self.sheets_service.get_shareable_link(credentials, spreadsheet_id)
-            print(f"[DEBUG] create_document: shareable_link={shareable_link}")
+            logger.debug("create_document: shareable_link=%s", shareable_link)
             logger.info(f"Document created successfully: {spreadsheet_id}")
             return shareable_link
         except Exception as e:
-            print(f"[ERROR] create_document: {e}")
-            traceback.print_exc()
-            logger.error(f"Document creation error: {e}")
+            logger.exception("Document creation error: %s", e)
             raise
 
     def upload_pdf_to_drive(self, credentials, pdf_path, user_id):
@@ -81,7 +77,7 @@ class DocumentGenerator:
             creation_method = session_data.get('creation_method', 'new_sheet')
             selected_spreadsheet_id = session_data.get('selected_spreadsheet_id')
             
-            print(f"[DEBUG] create_document_with_pdf: user_id={user_id}, document_type={document_type}, creation_method={creation_method}")
+            logger.debug("create_document_with_pdf: user_id=%s, document_type=%s, creation_method=%s", user_id, document_type, creation_method)
             credentials = self.auth_service.get_credentials(user_id)
             if not credentials:
                 raise Exception("Google認証が必要です")
@@ -91,7 +87,7 @@ class DocumentGenerator:
                 # 既存シートに追加
                 spreadsheet_id = selected_spreadsheet_id
                 is_first = False
-                print(f"[DEBUG] create_document_with_pdf: 既存シート使用 spreadsheet_id={spreadsheet_id}")
+                logger.debug("create_document_with_pdf: 既存シート使用 spreadsheet_id=%s", spreadsheet_id)
             elif creation_method == 'new_sheet':
                 # 新規シート作成：常に新しいスプレッドシートを作成
                 # 相手先会社名を取得してファイル名に含める
@@ -110,7 +106,7 @@ class DocumentGenerator:
                 else:
                     self.session_manager.save_invoice_spreadsheet_id(user_id, spreadsheet_id)
                 is_first = True
-                print(f"[DEBUG] create_document_with_pdf: 新規シート作成 spreadsheet_id={spreadsheet_id}")
+                logger.debug("create_document_with_pdf: 新規シート作成 spreadsheet_id=%s", spreadsheet_id)
             else:
                 # 作成方法が指定されていない場合：既存のスプレッドシートIDを取得
                 if document_type == 'estimate':
@@ -137,9 +133,9 @@ class DocumentGenerator:
                     else:
                         self.session_manager.save_invoice_spreadsheet_id(user_id, spreadsheet_id)
                     is_first = True
-                    print(f"[DEBUG] create_document_with_pdf: 新規spreadsheet_id={spreadsheet_id}")
+                    logger.debug("create_document_with_pdf: 新規spreadsheet_id=%s", spreadsheet_id)
                 else:
-                    print(f"[DEBUG] create_document_with_pdf: 既存spreadsheet_id={spreadsheet_id}")
+                    logger.debug("create_document_with_pdf: 既存spreadsheet_id=%s", spreadsheet_id)
 
             # シート名決定とシート番号取得
             if is_first:
@@ -154,31 +150,32 @@ class DocumentGenerator:
                 self.sheets_service.duplicate_sheet_via_gas(spreadsheet_id, template_sheet_name, sheet_name)
 
                 # シート番号を取得（全シート数）
-                from googleapiclient.discovery import build
-                service = build('sheets', 'v4', credentials=credentials)
-                spreadsheet_info = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+                service = self.sheets_service._get_service(credentials)
+                # 件数だけ分かればよいのでシートIDのみ取得する
+                spreadsheet_info = service.spreadsheets().get(
+                    spreadsheetId=spreadsheet_id,
+                    fields='sheets(properties(sheetId))'
+                ).execute()
                 sheet_count = len(spreadsheet_info.get('sheets', []))
 
             # データを準備して更新（シート番号を含める）
             document_data = self._prepare_document_data(session_data)
             document_data['sheet_count'] = sheet_count  # シート番号を追加
-            print(f"[DEBUG] create_document_with_pdf: document_data={document_data}, sheet_count={sheet_count}")
+            logger.debug("create_document_with_pdf: document_data=%s, sheet_count=%s", document_data, sheet_count)
             self.sheets_service.update_values(credentials, spreadsheet_id, {**document_data, 'document_type': document_type}, sheet_name=sheet_name)
 
             # 共有リンクを取得
             shareable_link = self.sheets_service.get_shareable_link(credentials, spreadsheet_id)
-            print(f"[DEBUG] create_document_with_pdf: shareable_link={shareable_link}")
+            logger.debug("create_document_with_pdf: shareable_link=%s", shareable_link)
             # PDFエクスポート処理はタイムアウト対策のためスキップ
             # PDFは後でダウンロードできるエンドポイント（/download/edited-sheets/）を使用
             pdf_filename = None
             pdf_file_id = None
-            print(f"[DEBUG] create_document_with_pdf: PDFエクスポート処理をスキップ（タイムアウト対策）")
+            logger.debug("create_document_with_pdf: PDFエクスポート処理をスキップ（タイムアウト対策）")
             logger.info(f"Document created successfully: {spreadsheet_id}, PDF export skipped")
             return shareable_link, pdf_filename, pdf_file_id
         except Exception as e:
-            print(f"[ERROR] create_document_with_pdf: {e}")
-            traceback.print_exc()
-            logger.error(f"Document with PDF creation error: {e}")
+            logger.exception("Document with PDF creation error: %s", e)
             raise
     
     def _prepare_document_data(self, session_data):
@@ -187,7 +184,7 @@ class DocumentGenerator:
         user_id = session_data.get('user_id')
         user_info = self.session_manager.get_user_info(user_id) or {}
 
-        print(f"[DEBUG] _prepare_document_data: user_id={user_id}, user_info={user_info}")
+        logger.debug("_prepare_document_data: user_id=%s, user_info=%s", user_id, user_info)
 
         # 品目の合計金額を計算
         items = session_data.get('items', [])
@@ -218,7 +215,7 @@ class DocumentGenerator:
             'items': items,
             'total_amount': total_amount,
         }
-        print(f"[DEBUG] _prepare_document_data: company_name={document_data['company_name']}, name={document_data['name']}, address={document_data['address']}, phone_number={document_data['phone_number']}, bank_account={document_data['bank_account']}, bank_account_holder={document_data['bank_account_holder']}")
+        logger.debug("_prepare_document_data: company_name=%s, name=%s, address=%s, phone_number=%s, bank_account=%s, bank_account_holder=%s", document_data['company_name'], document_data['name'], document_data['address'], document_data['phone_number'], document_data['bank_account'], document_data['bank_account_holder'])
         
         return document_data
     
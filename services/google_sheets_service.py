@@ -2,16 +2,95 @@ import os
 import logging
 import time
 import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import requests
+from requests.adapters import HTTPAdapter
 from google.auth.transport.requests import AuthorizedSession
 
 GAS_URL = "https://script.google.com/macros/s/AKfycbwG8PGqL0L-LgPf-9c622OVDfj6gPgA2QW9q14K4xHheIltgdTyoqGS-UF08n8ukKf2Wg/exec"
 
 logger = logging.getLogger(__name__)
 
+# ユーザーごとのスプレッドシート一覧キャッシュ（(user_id, document_type, max_results) -> (取得時刻, 一覧)）
+SPREADSHEET_LIST_CACHE_TTL = 90
+SPREADSHEET_LIST_CACHE_MAX_ENTRIES = 2000
+# TTLは一律なので挿入順＝古い順として先頭から捨てられる
+_spreadsheet_list_cache = OrderedDict()
+_spreadsheet_list_cache_lock = threading.Lock()
+
+def invalidate_spreadsheet_list_cache(user_id):
+    """指定ユーザーのスプレッドシート一覧キャッシュを破棄"""
+    with _spreadsheet_list_cache_lock:
+        for key in [key for key in _spreadsheet_list_cache if key[0] == user_id]:
+            del _spreadsheet_list_cache[key]
+
+# シート名→シートID(gid)のキャッシュ（spreadsheet_id -> (取得時刻, {シート名: sheetId})）
+# Sheets上でのシート名変更や削除・再作成はこちらから検知できないため、TTLは短めにする。
+# スプレッドシート単位でシート一覧を丸ごと差し替えるので、取り直した時点で
+# 名前が変わった・消えたシートのgidは残らない
+SHEET_GID_CACHE_TTL = 60
+SHEET_GID_CACHE_MAX_ENTRIES = 1000
+# 一覧キャッシュと同じく挿入順＝古い順として先頭から捨てる
+_sheet_gid_cache = OrderedDict()
+_sheet_gid_cache_lock = threading.Lock()
+
+def _store_sheet_gids(spreadsheet_id, sheet_ids):
+    """スプレッドシートの全シートのシート名→sheetIdを保存（期限切れと上限超過分は古い順に破棄）"""
+    now = time.monotonic()
+    with _sheet_gid_cache_lock:
+        _sheet_gid_cache.pop(spreadsheet_id, None)
+        _sheet_gid_cache[spreadsheet_id] = (now, dict(sheet_ids))
+        while _sheet_gid_cache:
+            cached_at, _ = next(iter(_sheet_gid_cache.values()))
+            if now - cached_at < SHEET_GID_CACHE_TTL and len(_sheet_gid_cache) <= SHEET_GID_CACHE_MAX_ENTRIES:
+                break
+            _sheet_gid_cache.popitem(last=False)
+
+def _add_sheet_gid(spreadsheet_id, sheet_name, sheet_id):
+    """追加したシートをキャッシュ済みの一覧に反映（一覧が無ければ次回の取得に任せる）"""
+    with _sheet_gid_cache_lock:
+        entry = _sheet_gid_cache.get(spreadsheet_id)
+        if entry:
+            # 取得時刻は元の一覧のものを引き継ぎ、追加で寿命を延ばさない
+            _sheet_gid_cache[spreadsheet_id] = (entry[0], {**entry[1], sheet_name: sheet_id})
+
+def invalidate_sheet_gids(spreadsheet_id):
+    """指定スプレッドシートのgidキャッシュを破棄"""
+    with _sheet_gid_cache_lock:
+        _sheet_gid_cache.pop(spreadsheet_id, None)
+
+# 認証済みHTTPセッションのプール（docs.google.comへのエクスポート用、LRUで上限管理）
+AUTHORIZED_SESSION_POOL_SIZE = 256
+_authorized_sessions = OrderedDict()
+_authorized_sessions_lock = threading.Lock()
+
+def get_authorized_session(credentials):
+    """ユーザーごとにAuthorizedSessionを使い回す（TLS接続を再利用し、トークン更新も任せる）"""
+    # refresh_tokenは認可ごとに一意なのでユーザーの識別に使う
+    key = credentials.refresh_token or id(credentials)
+    with _authorized_sessions_lock:
+        session = _authorized_sessions.get(key)
+        if session is not None:
+            _authorized_sessions.move_to_end(key)
+            # キャッシュ更新などで別オブジェクトになっていても最新の認証情報を使う
+            session.credentials = credentials
+            return session
+    session = AuthorizedSession(credentials)
+    session.mount('https://', HTTPAdapter(pool_maxsize=20))
+    with _authorized_sessions_lock:
+        _authorized_sessions[key] = session
+        while len(_authorized_sessions) > AUTHORIZED_SESSION_POOL_SIZE:
+            _, old_session = _authorized_sessions.popitem(last=False)
+            old_session.close()
+    return session
+
+# Sheets APIクライアントのプール（ユーザー×スレッドごと、LRUで上限管理）
+SHEETS_SERVICE_POOL_SIZE = 256
+
 class GoogleSheetsService:
     """Google Sheets API操作クラス"""
     
@@ -19,13 +98,28 @@ class GoogleSheetsService:
         # テンプレートIDを自動設定
         self.template_spreadsheet_id = "1FK9MDpEoHCySVgz83yjmZWOuyjrTaCDjRBEEWzafqgE"
         self.invoice_spreadsheet_id = "1XpxU_4eOmdhZ_pXMaec8ribVw0_J0IhRNI0IzVTiM4Y"
-        self.service = None
+        # インスタンスはアプリ全体で共有されるため、クライアントは認証情報ごとに持つ
+        self._services = OrderedDict()
+        self._services_lock = threading.Lock()
     
     def _get_service(self, credentials):
-        """Google Sheets APIサービスを取得"""
-        if not self.service:
-            self.service = build('sheets', 'v4', credentials=credentials)
-        return self.service
+        """渡された認証情報のGoogle Sheets APIサービスを取得"""
+        # refresh_tokenが無い認証情報は識別できないので、他ユーザーと取り違えないよう毎回作る
+        if not credentials.refresh_token:
+            return build('sheets', 'v4', credentials=credentials)
+        # httplib2はスレッドセーフではないため、同じユーザーでもスレッドごとに別のクライアントを使う
+        key = (credentials.refresh_token, threading.get_ident())
+        with self._services_lock:
+            service = self._services.get(key)
+            if service is not None:
+                self._services.move_to_end(key)
+                return service
+        service = build('sheets', 'v4', credentials=credentials)
+        with self._services_lock:
+            self._services[key] = service
+            while len(self._services) > SHEETS_SERVICE_POOL_SIZE:
+                self._services.popitem(last=False)
+        return service
     
     def copy_template(self, credentials, user_id, document_type, client_name=None):
         """テンプレートをコピー"""
@@ -56,6 +150,7 @@ class GoogleSheetsService:
                 body=copy_metadata
             ).execute()
             spreadsheet_id = copied_file['id']
+            invalidate_spreadsheet_list_cache(user_id)
             logger.info(f"Template copied: {spreadsheet_id} with name: {file_name}")
             return spreadsheet_id
         except HttpError as error:
@@ -107,7 +202,7 @@ class GoogleSheetsService:
                 phone_number = data.get('phone_number', '')
                 phone_with_label = f"TEL: {phone_number}" if phone_number else ''
 
-                print(f"[DEBUG] 請求書: 住所(F10)={data.get('address', '')}, 振込先(C34)={bank_full_info}")
+                logger.debug("請求書: 住所(F10)=%s, 振込先(C34)=%s", data.get('address', ''), bank_full_info)
                 basic_updates = [
                     ('G2', invoice_number),  # 請求書番号（G2）
                     ('F8', data.get('company_name', '')),  # 会社名（F8）
@@ -123,7 +218,7 @@ class GoogleSheetsService:
             batch_data = []
             for cell, value in basic_updates:
                 if value:  # 値がある場合のみ更新
-                    print(f"[DEBUG] update_values: {cell} ← {value}")
+                    logger.debug("update_values: %s ← %s", cell, value)
                     batch_data.append({
                         'range': f'{sheet_name}!{cell}',
                         'values': [[value]]
@@ -137,23 +232,23 @@ class GoogleSheetsService:
                         'data': batch_data
                     }
                 ).execute()
-                print(f"[DEBUG] update_values: 基本情報をバッチ更新完了（{len(batch_data)}件）")
+                logger.debug("update_values: 基本情報をバッチ更新完了（%s件）", len(batch_data))
             
             # 品目テーブルの更新（見積書・請求書で異なる）
             items = data.get('items', [])
-            print(f"[DEBUG] update_values: items={items}, items count={len(items) if items else 0}")
+            logger.debug("update_values: items=%s, items count=%s", items, len(items) if items else 0)
             if items:
                 if data.get('document_type') == 'estimate':
                     # 見積書の場合：A16〜E25（最大10行）をバッチ更新
                     max_items = 10
-                    print(f"[DEBUG] update_values: 見積書の品目書き込み開始 - {len(items)}件")
+                    logger.debug("update_values: 見積書の品目書き込み開始 - %s件", len(items))
 
                     item_batch_data = []
                     for i in range(max_items):
                         row = 16 + i
                         if i < len(items):
                             item = items[i]
-                            print(f"[DEBUG] update_values: 品目{i+1} - row={row}, name={item.get('name')}, quantity={item.get('quantity')}, price={item.get('price')}, amount={item.get('amount')}")
+                            logger.debug("update_values: 品目%s - row=%s, name=%s, quantity=%s, price=%s, amount=%s", i+1, row, item.get('name'), item.get('quantity'), item.get('price'), item.get('amount'))
 
                             # 品名、数量、単価を一括追加（見積書：D16に数量、E16に単価）
                             item_batch_data.append({'range': f'{sheet_name}!A{row}', 'values': [[item.get('name', '')]]})
@@ -174,15 +269,15 @@ class GoogleSheetsService:
                                 'data': item_batch_data
                             }
                         ).execute()
-                        print(f"[DEBUG] update_values: 品目をバッチ更新完了（{len(item_batch_data)}件）")
+                        logger.debug("update_values: 品目をバッチ更新完了（%s件）", len(item_batch_data))
                 else:
                     # 請求書の場合：A16、B16、E16、F16をバッチ更新
-                    print(f"[DEBUG] update_values: 請求書の品目書き込み開始 - {len(items)}件")
+                    logger.debug("update_values: 請求書の品目書き込み開始 - %s件", len(items))
 
                     invoice_batch_data = []
                     for i, item in enumerate(items):
                         row = 16 + i
-                        print(f"[DEBUG] update_values: 品目{i+1} - row={row}, name={item.get('name')}")
+                        logger.debug("update_values: 品目%s - row=%s, name=%s", i+1, row, item.get('name'))
 
                         # 取引日、品名、数量、単価を一括追加
                         invoice_batch_data.append({'range': f'{sheet_name}!A{row}', 'values': [[data.get('issue_date', '')]]})
@@ -199,10 +294,10 @@ class GoogleSheetsService:
                                 'data': invoice_batch_data
                             }
                         ).execute()
-                        print(f"[DEBUG] update_values: 請求書品目をバッチ更新完了（{len(invoice_batch_data)}件）")
+                        logger.debug("update_values: 請求書品目をバッチ更新完了（%s件）", len(invoice_batch_data))
             
             # 品目書き込み処理完了のログ
-            print(f"[DEBUG] update_values: 品目書き込み処理完了")
+            logger.debug("update_values: 品目書き込み処理完了")
             
             # 合計金額はエクセルで計算するため、プログラム側での書き込みは不要
             logger.info(f"Values updated successfully for {sheet_name}")
@@ -212,13 +307,26 @@ class GoogleSheetsService:
             logger.error(f"Values update error: {error}")
             raise
     
-    def get_sheet_id_by_name(self, service, spreadsheet_id, sheet_name):
-        """シート名からシートIDを取得"""
+    def get_sheet_id_by_name(self, service, spreadsheet_id, sheet_name, use_cache=True):
+        """シート名からシートIDを取得（取得結果はスプレッドシート単位でキャッシュ）
+
+        use_cache=Falseの場合はキャッシュを見ずにAPIから取り直す
+        """
+        if use_cache:
+            with _sheet_gid_cache_lock:
+                entry = _sheet_gid_cache.get(spreadsheet_id)
+            if entry and time.monotonic() - entry[0] < SHEET_GID_CACHE_TTL and sheet_name in entry[1]:
+                return entry[1][sheet_name]
         try:
-            spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            for sheet in spreadsheet['sheets']:
-                if sheet['properties']['title'] == sheet_name:
-                    return sheet['properties']['sheetId']
+            # シート名とIDだけを取得し、全シート分をまとめてキャッシュする
+            spreadsheet = service.spreadsheets().get(
+                spreadsheetId=spreadsheet_id,
+                fields='sheets(properties(sheetId,title))'
+            ).execute()
+            sheet_ids = {sheet['properties']['title']: sheet['properties']['sheetId'] for sheet in spreadsheet['sheets']}
+            _store_sheet_gids(spreadsheet_id, sheet_ids)
+            if sheet_name in sheet_ids:
+                return sheet_ids[sheet_name]
             raise Exception(f"シート名「{sheet_name}」が見つかりません")
         except Exception as error:
             logger.error(f"Sheet ID lookup error: {error}")
@@ -334,6 +442,12 @@ class GoogleSheetsService:
 
     def list_spreadsheets_by_type(self, credentials, document_type, max_results=10, user_id=None):
         """Google Drive上の指定タイプのスプレッドシート一覧を取得（botで作成したもののみ）"""
+        cache_key = (user_id, document_type, max_results)
+        if user_id:
+            with _spreadsheet_list_cache_lock:
+                entry = _spreadsheet_list_cache.get(cache_key)
+            if entry and time.monotonic() - entry[0] < SPREADSHEET_LIST_CACHE_TTL:
+                return entry[1]
         try:
             drive_service = build('drive', 'v3', credentials=credentials)
             
@@ -362,18 +476,31 @@ class GoogleSheetsService:
             ).execute()
             files = results.get('files', [])
             
-            # ファイル情報を整形
+            # ファイル情報を整形（表示用の更新日もここで作り、キャッシュ済みの一覧では再計算しない）
             formatted_files = []
             for file in files:
+                modified_time = file.get('modifiedTime', '')
                 formatted_files.append({
                     'id': file['id'],
                     'name': file['name'],
                     'created_time': file.get('createdTime', ''),
-                    'modified_time': file.get('modifiedTime', ''),
+                    'modified_time': modified_time,
+                    'modified_date': datetime.fromisoformat(modified_time.replace('Z', '+00:00')).strftime('%m/%d') if modified_time else '',
                     'url': f"https://docs.google.com/spreadsheets/d/{file['id']}/edit"
                 })
             
             logger.info(f"Found {len(formatted_files)} {document_type} spreadsheets created by bot")
+            if user_id:
+                now = time.monotonic()
+                with _spreadsheet_list_cache_lock:
+                    _spreadsheet_list_cache.pop(cache_key, None)
+                    _spreadsheet_list_cache[cache_key] = (now, formatted_files)
+                    # 期限切れと上限超過分を古い順に破棄
+                    while _spreadsheet_list_cache:
+                        cached_at, _ = next(iter(_spreadsheet_list_cache.values()))
+                        if now - cached_at < SPREADSHEET_LIST_CACHE_TTL and len(_spreadsheet_list_cache) <= SPREADSHEET_LIST_CACHE_MAX_ENTRIES:
+                            break
+                        _spreadsheet_list_cache.popitem(last=False)
             return formatted_files
             
         except Exception as e:
@@ -406,6 +533,7 @@ class GoogleSheetsService:
             body=add_sheet_request
         ).execute()
         new_sheet_id = response['replies'][0]['addSheet']['properties']['sheetId']
+        _add_sheet_gid(spreadsheet_id, new_sheet_name, new_sheet_id)
         # 3. テンプレート内容（値・書式）を新シートにコピー
         # 値と書式をcopyPasteでコピー
         copy_paste_request = {
@@ -456,7 +584,10 @@ class GoogleSheetsService:
     def get_next_estimate_sheet_name(self, credentials, spreadsheet_id, base_name="見積書"):
         """既存の見積書シート名から次の番号のシート名を決定"""
         service = self._get_service(credentials)
-        spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+        spreadsheet = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets(properties(title))'
+        ).execute()
         sheet_names = [sheet['properties']['title'] for sheet in spreadsheet['sheets']]
         max_num = 1
         for name in sheet_names:
@@ -473,11 +604,23 @@ class GoogleSheetsService:
         else:
             return f"{base_name}{max_num+1}" 
 
+    def get_modified_time(self, credentials, file_id):
+        """Drive上のファイルの最終更新日時（RFC 3339文字列）を取得。取得できなければNone"""
+        try:
+            drive_service = build('drive', 'v3', credentials=credentials)
+            return drive_service.files().get(fileId=file_id, fields='modifiedTime').execute().get('modifiedTime')
+        except Exception as e:
+            logger.warning("get_modified_time error: %s", e)
+            return None
+
     def get_edited_sheets(self, credentials, spreadsheet_id):
         """編集されたシートのリストを取得"""
         try:
             service = self._get_service(credentials)
-            spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+            spreadsheet = service.spreadsheets().get(
+                spreadsheetId=spreadsheet_id,
+                fields='sheets(properties(sheetId,title))'
+            ).execute()
             
             edited_sheets = []
             for sheet in spreadsheet['sheets']:
@@ -602,7 +745,7 @@ class GoogleSheetsService:
                 export_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=pdf&gid={sheet_id}&single=true&portrait=true&size=A4&fitw=true&top_margin=0.5&bottom_margin=0.5&left_margin=0.5&right_margin=0.5"
                 
                 # 認証付きでPDF取得
-                authed_session = AuthorizedSession(credentials)
+                authed_session = get_authorized_session(credentials)
                 response = authed_session.get(export_url)
                 
                 if response.status_code == 200:
@@ -661,5 +804,6 @@ class GoogleSheetsService:
             spreadsheetId=spreadsheet_id,
             body={'requests': requests}
         ).execute()
+        invalidate_sheet_gids(spreadsheet_id)
         logger.info(f"Deleted sheet: {sheet_name} (ID: {sheet_id}) from {spreadsheet_id}")
         return True 
\ No newline at end of file
@@ -1,12 +1,24 @@
 import os
 import logging
-import psycopg2
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any
 import re
+from .session_manager import get_session_manager
 
 logger = logging.getLogger(__name__)
 
+@contextmanager
+def _db_connection():
+    """SessionManagerの接続プールから接続を借り、ブロック全体を1トランザクションとして実行する"""
+    with get_session_manager().pg_connection() as conn:
+        # psycopg2の接続をwithで使うと、正常終了時にコミット・例外時にロールバックされる（接続は閉じない）
+        with conn:
+            yield conn
+
+# メールアドレスの形式チェック用
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
 class RestrictionChecker:
     def __init__(self, content_type: str = "AI経理秘書"):
         self.content_type = content_type
@@ -35,7 +47,7 @@ class RestrictionChecker:
             }
         
         try:
-            with psycopg2.connect(self.database_url) as conn:
+            with _db_connection() as conn:
                 with conn.cursor() as cursor:
                     # ユーザーを検索（email優先、次にline_user_id）
                     user = None
@@ -181,7 +193,7 @@ class RestrictionChecker:
             }
         
         try:
-            with psycopg2.connect(self.database_url) as conn:
+            with _db_connection() as conn:
                 with conn.cursor() as cursor:
                     # 1. ユーザーIDを取得
                     cursor.execute("""
@@ -315,8 +327,7 @@ class RestrictionChecker:
     
     def _is_valid_email(self, email: str) -> bool:
         """メールアドレスの形式をチェック"""
-        pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        return re.match(pattern, email) is not None
+        return EMAIL_PATTERN.match(email) is not None
 
 def safe_check_restriction(line_user_id: str, email: str = None, content_type: str = "AI経理秘書") -> Dict[str, Any]:
     """
@@ -360,7 +371,7 @@ def create_subscription(user_id: int, content_type: str, duration_days: int = 30
         return False
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with _db_connection() as conn:
             with conn.cursor() as cursor:
                 # 既存のアクティブな契約を無効化
                 cursor.execute("""
@@ -400,7 +411,7 @@ def extend_subscription(subscription_id: int, additional_days: int) -> bool:
         return False
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with _db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                     UPDATE subscriptions 
@@ -436,7 +447,7 @@ def cancel_subscription(subscription_id: int) -> bool:
         return False
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with _db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                     UPDATE subscriptions 
@@ -472,7 +483,7 @@ def get_user_subscriptions(user_id: int) -> list:
         return []
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with _db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                     SELECT id, content_type, start_date, end_date, status, created_at, updated_at
@@ -1,35 +1,38 @@
 import json
 import sqlite3
 import os
+import copy
+import threading
+from contextlib import contextmanager
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from datetime import datetime, timedelta
 import logging
-import traceback
 
 logger = logging.getLogger(__name__)
 
+def _dump_session(session_data):
+    """セッションをTEXT列に保存する形へ変換（日本語はエスケープせずUTF-8のまま、区切りの空白も省く）"""
+    return json.dumps(session_data, ensure_ascii=False, separators=(',', ':'))
+
 class SessionManager:
     """ユーザーセッション管理クラス"""
     
     def __init__(self):
         self.db_url = os.getenv('DATABASE_URL', 'sqlite:///sessions.db')
         self.use_postgres = self.db_url.startswith('postgresql://')
-        
-        # デバッグ情報を詳細に出力
-        print(f"[DEBUG] SessionManager: DATABASE_URL環境変数存在={os.getenv('DATABASE_URL') is not None}")
-        print(f"[DEBUG] SessionManager: DATABASE_URL値={self.db_url[:50] if self.db_url else 'None'}...")
-        print(f"[DEBUG] SessionManager: use_postgres={self.use_postgres}")
+        # PostgreSQL接続プール（初回利用時に作成）
+        self._pg_pool = None
+        self._pg_pool_lock = threading.Lock()
+        self._pg_pool_maxconn = int(os.getenv('DB_POOL_MAXCONN', '20'))
         
         if self.use_postgres:
-            print(f"[DEBUG] SessionManager: PostgreSQL使用 - {self.db_url[:50]}...")
             try:
                 self._init_postgres_db()
-                print("[DEBUG] SessionManager: PostgreSQL初期化成功")
+                logger.debug("SessionManager: PostgreSQL初期化成功")
             except Exception as e:
-                print(f"[ERROR] SessionManager: PostgreSQL初期化失敗 - {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("SessionManager: PostgreSQL初期化失敗 - %s", e)
         else:
             # SQLiteファイルパスを抽出
             if self.db_url.startswith('sqlite:///'):
@@ -37,18 +40,65 @@ class SessionManager:
             else:
                 db_path = 'sessions.db'
             abs_db_path = os.path.abspath(db_path)
-            print(f"[DEBUG] SessionManager: SQLite使用 - DBファイル絶対パス={abs_db_path}")
+            logger.debug("SessionManager: SQLite使用 - DBファイル絶対パス=%s", abs_db_path)
             self.db_path = abs_db_path
             try:
                 self._init_sqlite_db()
-                print("[DEBUG] SessionManager: SQLite初期化成功")
+                logger.debug("SessionManager: SQLite初期化成功")
             except Exception as e:
-                print(f"[ERROR] SessionManager: SQLite初期化失敗 - {e}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("SessionManager: SQLite初期化失敗 - %s", e)
         
         # データベースの種類をログに出力
-        print(f"[DEBUG] SessionManager: データベースタイプ={'PostgreSQL' if self.use_postgres else 'SQLite'}")
+        logger.info("SessionManager: データベースタイプ=%s", 'PostgreSQL' if self.use_postgres else 'SQLite')
+        
+        # リクエスト単位のセッションキャッシュ（request_scope内でのみ有効）
+        self._local = threading.local()
+    
+    @contextmanager
+    def request_scope(self):
+        """ブロック内ではget_sessionの結果を使い回す（Webhook1回分の処理を囲む）"""
+        self._local.sessions = {}
+        try:
+            yield
+        finally:
+            self._local.sessions = None
+    
+    def _get_request_cache(self):
+        """現在のスレッドのリクエスト単位キャッシュを取得（スコープ外ならNone）"""
+        return getattr(self._local, 'sessions', None)
+    
+    def _get_pg_pool(self):
+        """PostgreSQL接続プールを取得（未作成なら作成）"""
+        if self._pg_pool is None:
+            with self._pg_pool_lock:
+                if self._pg_pool is None:
+                    self._pg_pool = ThreadedConnectionPool(1, self._pg_pool_maxconn, self.db_url)
+        return self._pg_pool
+    
+    @contextmanager
+    def _pg_connection(self):
+        """プールからPostgreSQL接続を借りて、ブロックを抜けたら返却する"""
+        pool = self._get_pg_pool()
+        try:
+            conn = pool.getconn()
+            pooled = True
+        except PoolError:
+            # プールが枯渇している場合はその場限りの接続で処理する
+            logger.warning("PostgreSQL接続プールが枯渇したため一時接続を使用します")
+            conn = psycopg2.connect(self.db_url)
+            pooled = False
+        try:
+            yield conn
+        finally:
+            if pooled:
+                # 未コミットのトランザクションはputconn側でロールバックされる
+                pool.putconn(conn, close=bool(conn.closed))
+            else:
+                conn.close()
+    
+    def pg_connection(self):
+        """接続プールからPostgreSQL接続を借りる（他モジュールと同じプールを共有するための入口）"""
+        return self._pg_connection()
     
     def _init_sqlite_db(self):
         """SQLiteデータベースの初期化"""
@@ -129,41 +179,40 @@ class SessionManager:
     def _init_postgres_db(self):
         """PostgreSQLデータベースの初期化"""
         try:
-            conn = psycopg2.connect(self.db_url)
-            cursor = conn.cursor()
+            with self._pg_connection() as conn:
+                cursor = conn.cursor()
             
-            # セッションテーブルの作成
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sessions (
-                    user_id VARCHAR(255) PRIMARY KEY,
-                    session_data TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                # セッションテーブルの作成
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS sessions (
+                        user_id VARCHAR(255) PRIMARY KEY,
+                        session_data TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
             
-            # ユーザー情報テーブルの作成
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id VARCHAR(255) PRIMARY KEY,
-                    company_name TEXT,
-                    name TEXT,
-                    address TEXT,
-                    phone_number TEXT,
-                    bank_account TEXT,
-                    bank_account_holder TEXT,
-                    google_refresh_token TEXT,
-                    spreadsheet_id TEXT,
-                    estimate_spreadsheet_id TEXT,
-                    invoice_spreadsheet_id TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                # ユーザー情報テーブルの作成
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id VARCHAR(255) PRIMARY KEY,
+                        company_name TEXT,
+                        name TEXT,
+                        address TEXT,
+                        phone_number TEXT,
+                        bank_account TEXT,
+                        bank_account_holder TEXT,
+                        google_refresh_token TEXT,
+                        spreadsheet_id TEXT,
+                        estimate_spreadsheet_id TEXT,
+                        invoice_spreadsheet_id TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
             
-            conn.commit()
-            cursor.close()
-            conn.close()
+                conn.commit()
+                cursor.close()
             logger.info("PostgreSQL Database initialized successfully")
             
         except Exception as e:
@@ -172,22 +221,20 @@ class SessionManager:
     def create_session(self, user_id, session_data):
         """新しいセッションを作成"""
         try:
-            print(f"[DEBUG] create_session: user_id={user_id}, session_data={session_data}")
+            logger.debug("create_session: user_id=%s, session_data=%s", user_id, session_data)
             
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                
-                # PostgreSQL用のUPSERT
-                cursor.execute('''
-                    INSERT INTO sessions (user_id, session_data, updated_at)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (user_id) 
-                    DO UPDATE SET session_data = EXCLUDED.session_data, updated_at = EXCLUDED.updated_at
-                ''', (user_id, json.dumps(session_data), datetime.now()))
-                
-                print(f"[DEBUG] create_session: PostgreSQL INSERT/UPDATE実行完了")
-                
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    
+                    # PostgreSQL用のUPSERT
+                    cursor.execute('''
+                        INSERT INTO sessions (user_id, session_data, updated_at)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (user_id) 
+                        DO UPDATE SET session_data = EXCLUDED.session_data, updated_at = EXCLUDED.updated_at
+                    ''', (user_id, _dump_session(session_data), datetime.now()))
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -196,75 +243,60 @@ class SessionManager:
                 cursor.execute('''
                     INSERT OR REPLACE INTO sessions (user_id, session_data, updated_at)
                     VALUES (?, ?, ?)
-                ''', (user_id, json.dumps(session_data), datetime.now()))
-                
-                print(f"[DEBUG] create_session: SQLite INSERT/REPLACE実行完了")
-            
-            conn.commit()
-            print(f"[DEBUG] create_session: コミット完了")
-            conn.close()
-            print(f"[DEBUG] create_session: 接続クローズ完了")
+                ''', (user_id, _dump_session(session_data), datetime.now()))
+                conn.commit()
+                conn.close()
             
-            # 保存直後に確認（簡易版）
-            if self.use_postgres:
-                conn2 = psycopg2.connect(self.db_url)
-                cursor2 = conn2.cursor()
-                cursor2.execute('SELECT COUNT(*) FROM sessions WHERE user_id = %s', (user_id,))
-                count = cursor2.fetchone()[0]
-                conn2.close()
-                print(f"[DEBUG] create_session: 保存直後の確認 - セッション数={count}")
-            else:
-                conn2 = sqlite3.connect(self.db_path, check_same_thread=False)
-                cursor2 = conn2.cursor()
-                cursor2.execute('SELECT COUNT(*) FROM sessions WHERE user_id = ?', (user_id,))
-                count = cursor2.fetchone()[0]
-                conn2.close()
-                print(f"[DEBUG] create_session: 保存直後の確認 - セッション数={count}")
+            cache = self._get_request_cache()
+            if cache is not None:
+                cache[user_id] = copy.deepcopy(session_data)
             
-            logger.info(f"Session created/updated for user: {user_id}")
+            logger.debug("Session created/updated for user: %s", user_id)
             
         except Exception as e:
-            print(f"[ERROR] create_session: {e}")
-            import traceback
-            traceback.print_exc()
-            logger.error(f"Session creation error: {e}")
+            logger.exception("Session creation error: %s", e)
     
     def get_session(self, user_id):
-        """セッション情報を取得"""
+        """セッション情報を取得（request_scope内では同じリクエスト中の取得結果を再利用）"""
+        cache = self._get_request_cache()
+        if cache is not None and user_id in cache:
+            return copy.deepcopy(cache[user_id])
+        session_data = self._fetch_session(user_id)
+        if cache is not None:
+            cache[user_id] = copy.deepcopy(session_data)
+        return session_data
+    
+    def _fetch_session(self, user_id):
+        """データベースからセッション情報を取得"""
         try:
-            print(f"[DEBUG] get_session: user_id={user_id}")
+            logger.debug("get_session: user_id=%s", user_id)
             
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
                 
-                # まず最新のセッションを取得（時間制限なし）
-                cursor.execute('''
-                    SELECT session_data, updated_at FROM sessions 
-                    WHERE user_id = %s
-                    ORDER BY updated_at DESC
-                    LIMIT 1
-                ''', (user_id,))
+                    # まず最新のセッションを取得（時間制限なし）
+                    cursor.execute('''
+                        SELECT session_data, updated_at FROM sessions 
+                        WHERE user_id = %s
+                        ORDER BY updated_at DESC
+                        LIMIT 1
+                    ''', (user_id,))
                 
-                result = cursor.fetchone()
-                conn.close()
+                    result = cursor.fetchone()
                 
                 if result:
                     session_data_str, updated_at = result
-                    print(f"[DEBUG] get_session: セッション発見 - updated_at={updated_at}")
-                    
                     # 24時間以内かチェック
                     if updated_at > datetime.now() - timedelta(hours=24):
                         session_data = json.loads(session_data_str)
-                        logger.info(f"Session retrieved for user: {user_id}")
+                        logger.debug("Session retrieved for user: %s", user_id)
                         return session_data
                     else:
-                        print(f"[DEBUG] get_session: セッション期限切れ - updated_at={updated_at}")
-                        logger.info(f"Session expired for user: {user_id}")
+                        logger.debug("Session expired for user: %s (updated_at=%s)", user_id, updated_at)
                         return None
                 else:
-                    print(f"[DEBUG] get_session: セッションが見つからない")
-                    logger.info(f"No session found for user: {user_id}")
+                    logger.debug("No session found for user: %s", user_id)
                     return None
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
@@ -283,52 +315,50 @@ class SessionManager:
                 
                 if result:
                     session_data_str, updated_at = result
-                    print(f"[DEBUG] get_session: セッション発見 - updated_at={updated_at}")
-                    
                     # 24時間以内かチェック
                     if updated_at > datetime.now() - timedelta(hours=24):
                         session_data = json.loads(session_data_str)
-                        logger.info(f"Session retrieved for user: {user_id}")
+                        logger.debug("Session retrieved for user: %s", user_id)
                         return session_data
                     else:
-                        print(f"[DEBUG] get_session: セッション期限切れ - updated_at={updated_at}")
-                        logger.info(f"Session expired for user: {user_id}")
+                        logger.debug("Session expired for user: %s (updated_at=%s)", user_id, updated_at)
                         return None
                 else:
-                    print(f"[DEBUG] get_session: セッションが見つからない")
-                    logger.info(f"No session found for user: {user_id}")
+                    logger.debug("No session found for user: %s", user_id)
                     return None
                 
         except Exception as e:
-            print(f"[ERROR] get_session: {e}")
-            import traceback
-            traceback.print_exc()
-            logger.error(f"Session retrieval error: {e}")
+            logger.exception("Session retrieval error: %s", e)
             return None
     
     def update_session(self, user_id, updates):
-        """セッション情報を更新"""
+        """セッション情報を更新
+
+        書類生成など別スレッドからの更新と競合しても取りこぼさないよう、request_scope内でも
+        キャッシュした内容ではなく保存済みの行に対してupdatesの項目だけをマージする
+        """
         try:
-            print(f"[DEBUG] update_session: user_id={user_id}, updates={updates}")
+            logger.debug("update_session: user_id=%s, updates=%s", user_id, updates)
             
-            # 直接データベースから現在のセッションを取得（無限ループ回避）
-            current_session = {}
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT session_data FROM sessions 
-                    WHERE user_id = %s
-                    ORDER BY updated_at DESC
-                    LIMIT 1
-                ''', (user_id,))
-                result = cursor.fetchone()
-                if result:
-                    current_session = json.loads(result[0])
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    # 読み出しとマージを1文で行い、間に他の更新が割り込まないようにする
+                    cursor.execute('''
+                        INSERT INTO sessions (user_id, session_data, updated_at)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET session_data = (COALESCE(sessions.session_data, '{}')::jsonb || EXCLUDED.session_data::jsonb)::text,
+                                      updated_at = EXCLUDED.updated_at
+                        RETURNING session_data
+                    ''', (user_id, _dump_session(updates), datetime.now()))
+                    updated_session = json.loads(cursor.fetchone()[0])
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
+                # SQLiteは書き込みトランザクション内で読み直してからマージする
+                cursor.execute('BEGIN IMMEDIATE')
                 cursor.execute('''
                     SELECT session_data FROM sessions 
                     WHERE user_id = ?
@@ -336,37 +366,34 @@ class SessionManager:
                     LIMIT 1
                 ''', (user_id,))
                 result = cursor.fetchone()
-                if result:
-                    current_session = json.loads(result[0])
+                current_session = json.loads(result[0]) if result and result[0] else {}
+                updated_session = {**current_session, **updates}
+                cursor.execute('''
+                    INSERT OR REPLACE INTO sessions (user_id, session_data, updated_at)
+                    VALUES (?, ?, ?)
+                ''', (user_id, _dump_session(updated_session), datetime.now()))
+                conn.commit()
                 conn.close()
             
-            print(f"[DEBUG] update_session: current_session={current_session}")
-            
-            updated_session = {**current_session, **updates}
-            print(f"[DEBUG] update_session: updated_session={updated_session}")
+            cache = self._get_request_cache()
+            if cache is not None:
+                cache[user_id] = updated_session
             
-            self.create_session(user_id, updated_session)
-            print(f"[DEBUG] update_session: create_session呼び出し完了")
-            
-            logger.info(f"Session updated for user: {user_id}")
+            logger.debug("Session updated for user: %s", user_id)
             
         except Exception as e:
-            print(f"[ERROR] update_session: {e}")
-            import traceback
-            traceback.print_exc()
-            logger.error(f"Session update error: {e}")
+            logger.exception("Session update error: %s", e)
     
     def delete_session(self, user_id):
         """セッションを削除"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
                 
-                cursor.execute('DELETE FROM sessions WHERE user_id = %s', (user_id,))
+                    cursor.execute('DELETE FROM sessions WHERE user_id = %s', (user_id,))
                 
-                conn.commit()
-                conn.close()
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -376,6 +403,10 @@ class SessionManager:
                 conn.commit()
                 conn.close()
             
+            cache = self._get_request_cache()
+            if cache is not None:
+                cache.pop(user_id, None)
+            
             logger.info(f"Session deleted for user: {user_id}")
             
         except Exception as e:
@@ -385,11 +416,62 @@ class SessionManager:
         """ユーザー情報を永続化"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                
+                    # 既存ユーザーのgoogle_refresh_tokenを取得
+                    cursor.execute('SELECT google_refresh_token FROM users WHERE user_id = %s', (user_id,))
+                    existing_token = cursor.fetchone()
+                    if existing_token:
+                        google_refresh_token = existing_token[0]
+                    else:
+                        google_refresh_token = None
+
+                    # INSERT OR REPLACEだとトークンが消えるので、REPLACEではなくUPDATE/INSERTを分岐
+                    cursor.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
+                    user_exists = cursor.fetchone()
+                    if user_exists:
+                        # UPDATE時はトークンを保持
+                        cursor.execute('''
+                            UPDATE users SET company_name = %s, name = %s, address = %s, phone_number = %s,
+                                           bank_account = %s, bank_account_holder = %s, updated_at = %s
+                            WHERE user_id = %s
+                        ''', (
+                            user_info.get('company_name'),
+                            user_info.get('name'),
+                            user_info.get('address'),
+                            user_info.get('phone_number'),
+                            user_info.get('bank_account'),
+                            user_info.get('bank_account_holder'),
+                            datetime.now(),
+                            user_id
+                        ))
+                    else:
+                        # INSERT時はトークンはNoneでOK
+                        cursor.execute('''
+                            INSERT INTO users (user_id, company_name, name, address, phone_number,
+                                             bank_account, bank_account_holder, google_refresh_token, created_at, updated_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        ''', (
+                            user_id,
+                            user_info.get('company_name'),
+                            user_info.get('name'),
+                            user_info.get('address'),
+                            user_info.get('phone_number'),
+                            user_info.get('bank_account'),
+                            user_info.get('bank_account_holder'),
+                            google_refresh_token,
+                            datetime.now(),
+                            datetime.now()
+                        ))
                 
+                    conn.commit()
+            else:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                cursor = conn.cursor()
+
                 # 既存ユーザーのgoogle_refresh_tokenを取得
-                cursor.execute('SELECT google_refresh_token FROM users WHERE user_id = %s', (user_id,))
+                cursor.execute('SELECT google_refresh_token FROM users WHERE user_id = ?', (user_id,))
                 existing_token = cursor.fetchone()
                 if existing_token:
                     google_refresh_token = existing_token[0]
@@ -397,14 +479,14 @@ class SessionManager:
                     google_refresh_token = None
 
                 # INSERT OR REPLACEだとトークンが消えるので、REPLACEではなくUPDATE/INSERTを分岐
-                cursor.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
+                cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
                 user_exists = cursor.fetchone()
                 if user_exists:
                     # UPDATE時はトークンを保持
                     cursor.execute('''
-                        UPDATE users SET company_name = %s, name = %s, address = %s, phone_number = %s,
-                                       bank_account = %s, bank_account_holder = %s, updated_at = %s
-                        WHERE user_id = %s
+                        UPDATE users SET company_name = ?, name = ?, address = ?, phone_number = ?,
+                                       bank_account = ?, bank_account_holder = ?, updated_at = ?
+                        WHERE user_id = ?
                     ''', (
                         user_info.get('company_name'),
                         user_info.get('name'),
@@ -420,7 +502,7 @@ class SessionManager:
                     cursor.execute('''
                         INSERT INTO users (user_id, company_name, name, address, phone_number,
                                          bank_account, bank_account_holder, google_refresh_token, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     ''', (
                         user_id,
                         user_info.get('company_name'),
@@ -433,61 +515,9 @@ class SessionManager:
                         datetime.now(),
                         datetime.now()
                     ))
-                
+
                 conn.commit()
                 conn.close()
-            else:
-                conn = sqlite3.connect(self.db_path, check_same_thread=False)
-                cursor = conn.cursor()
-
-            # 既存ユーザーのgoogle_refresh_tokenを取得
-            cursor.execute('SELECT google_refresh_token FROM users WHERE user_id = ?', (user_id,))
-            existing_token = cursor.fetchone()
-            if existing_token:
-                google_refresh_token = existing_token[0]
-            else:
-                google_refresh_token = None
-
-            # INSERT OR REPLACEだとトークンが消えるので、REPLACEではなくUPDATE/INSERTを分岐
-            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-            user_exists = cursor.fetchone()
-            if user_exists:
-                # UPDATE時はトークンを保持
-                cursor.execute('''
-                    UPDATE users SET company_name = ?, name = ?, address = ?, phone_number = ?,
-                                   bank_account = ?, bank_account_holder = ?, updated_at = ?
-                    WHERE user_id = ?
-                ''', (
-                    user_info.get('company_name'),
-                    user_info.get('name'),
-                    user_info.get('address'),
-                    user_info.get('phone_number'),
-                    user_info.get('bank_account'),
-                    user_info.get('bank_account_holder'),
-                    datetime.now(),
-                    user_id
-                ))
-            else:
-                # INSERT時はトークンはNoneでOK
-                cursor.execute('''
-                    INSERT INTO users (user_id, company_name, name, address, phone_number,
-                                     bank_account, bank_account_holder, google_refresh_token, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id,
-                    user_info.get('company_name'),
-                    user_info.get('name'),
-                    user_info.get('address'),
-                    user_info.get('phone_number'),
-                    user_info.get('bank_account'),
-                    user_info.get('bank_account_holder'),
-                    google_refresh_token,
-                    datetime.now(),
-                    datetime.now()
-                ))
-
-            conn.commit()
-            conn.close()
             logger.info(f"User info saved for user: {user_id}")
         except Exception as e:
             logger.error(f"User info save error: {e}")
@@ -496,16 +526,15 @@ class SessionManager:
         """ユーザー情報を取得"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
                 
-                cursor.execute('''
-                    SELECT company_name, name, address, phone_number, bank_account, bank_account_holder
-                    FROM users WHERE user_id = %s
-                ''', (user_id,))
+                    cursor.execute('''
+                        SELECT company_name, name, address, phone_number, bank_account, bank_account_holder
+                        FROM users WHERE user_id = %s
+                    ''', (user_id,))
                 
-                result = cursor.fetchone()
-                conn.close()
+                    result = cursor.fetchone()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -537,32 +566,29 @@ class SessionManager:
     def save_google_token(self, user_id, refresh_token):
         """Google認証トークンを保存"""
         try:
-            print(f"[DEBUG] save_google_token: user_id={user_id}, refresh_token={refresh_token}")
+            logger.debug("save_google_token: user_id=%s", user_id)
             
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                
-                # まずユーザーが存在するかチェック
-                cursor.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
-                user_exists = cursor.fetchone()
-                print(f"[DEBUG] save_google_token: user_exists={user_exists}")
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
                 
-                if user_exists:
-                    # 既存ユーザーの場合、UPDATE
-                    cursor.execute('''
-                        UPDATE users SET google_refresh_token = %s, updated_at = %s
-                        WHERE user_id = %s
-                    ''', (refresh_token, datetime.now(), user_id))
-                else:
-                    # 新規ユーザーの場合、INSERT
-                    cursor.execute('''
-                        INSERT INTO users (user_id, google_refresh_token, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (user_id, refresh_token, datetime.now(), datetime.now()))
+                    # まずユーザーが存在するかチェック
+                    cursor.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
+                    user_exists = cursor.fetchone()
+                    if user_exists:
+                        # 既存ユーザーの場合、UPDATE
+                        cursor.execute('''
+                            UPDATE users SET google_refresh_token = %s, updated_at = %s
+                            WHERE user_id = %s
+                        ''', (refresh_token, datetime.now(), user_id))
+                    else:
+                        # 新規ユーザーの場合、INSERT
+                        cursor.execute('''
+                            INSERT INTO users (user_id, google_refresh_token, created_at, updated_at)
+                            VALUES (%s, %s, %s, %s)
+                        ''', (user_id, refresh_token, datetime.now(), datetime.now()))
                 
-                conn.commit()
-                conn.close()
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -570,8 +596,6 @@ class SessionManager:
                 # まずユーザーが存在するかチェック
                 cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
                 user_exists = cursor.fetchone()
-                print(f"[DEBUG] save_google_token: user_exists={user_exists}")
-                
                 if user_exists:
                     # 既存ユーザーの場合、UPDATE
                     cursor.execute('''
@@ -591,25 +615,21 @@ class SessionManager:
             logger.info(f"Google token saved for user: {user_id}")
             
         except Exception as e:
-            print(f"[ERROR] save_google_token: {e}")
-            traceback.print_exc()
-            logger.error(f"Google token save error: {e}")
+            logger.exception("Google token save error: %s", e)
     
     def get_google_token(self, user_id):
         """Google認証トークンを取得"""
         try:
-            print(f"[DEBUG] get_google_token: user_id={user_id}")
+            logger.debug("get_google_token: user_id=%s", user_id)
             
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                # 全カラム取得に変更
-                cursor.execute('''
-                    SELECT * FROM users WHERE user_id = %s
-                ''', (user_id,))
-                result = cursor.fetchone()
-                print(f"[DEBUG] get_google_token: 全カラムresult={result}")
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    # 全カラム取得に変更
+                    cursor.execute('''
+                        SELECT * FROM users WHERE user_id = %s
+                    ''', (user_id,))
+                    result = cursor.fetchone()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -618,34 +638,29 @@ class SessionManager:
                     SELECT * FROM users WHERE user_id = ?
                 ''', (user_id,))
                 result = cursor.fetchone()
-                print(f"[DEBUG] get_google_token: 全カラムresult={result}")
                 conn.close()
             
             # 旧来の動作も維持
             if result and len(result) >= 5:
                 google_refresh_token = result[4]
-                print(f"[DEBUG] get_google_token: google_refresh_token={google_refresh_token}")
                 return google_refresh_token
             else:
-                print(f"[DEBUG] get_google_token: トークンカラムが見つかりません")
+                logger.debug("get_google_token: トークンカラムが見つかりません")
                 return None
         except Exception as e:
-            print(f"[ERROR] get_google_token: {e}")
-            traceback.print_exc()
-            logger.error(f"Google token retrieval error: {e}")
+            logger.exception("Google token retrieval error: %s", e)
             return None 
 
     def save_spreadsheet_id(self, user_id, spreadsheet_id):
         """ユーザーごとのスプレッドシートIDを保存"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE users SET spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
-                ''', (spreadsheet_id, datetime.now(), user_id))
-                conn.commit()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        UPDATE users SET spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
+                    ''', (spreadsheet_id, datetime.now(), user_id))
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -662,13 +677,12 @@ class SessionManager:
         """ユーザーごとのスプレッドシートIDを取得"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT spreadsheet_id FROM users WHERE user_id = %s
-                ''', (user_id,))
-                result = cursor.fetchone()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT spreadsheet_id FROM users WHERE user_id = %s
+                    ''', (user_id,))
+                    result = cursor.fetchone()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -689,13 +703,12 @@ class SessionManager:
         """見積書用スプレッドシートIDを保存"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE users SET estimate_spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
-                ''', (spreadsheet_id, datetime.now(), user_id))
-                conn.commit()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        UPDATE users SET estimate_spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
+                    ''', (spreadsheet_id, datetime.now(), user_id))
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -712,13 +725,12 @@ class SessionManager:
         """見積書用スプレッドシートIDを取得"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT estimate_spreadsheet_id FROM users WHERE user_id = %s
-                ''', (user_id,))
-                result = cursor.fetchone()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT estimate_spreadsheet_id FROM users WHERE user_id = %s
+                    ''', (user_id,))
+                    result = cursor.fetchone()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -739,13 +751,12 @@ class SessionManager:
         """請求書用スプレッドシートIDを保存"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE users SET invoice_spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
-                ''', (spreadsheet_id, datetime.now(), user_id))
-                conn.commit()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        UPDATE users SET invoice_spreadsheet_id = %s, updated_at = %s WHERE user_id = %s
+                    ''', (spreadsheet_id, datetime.now(), user_id))
+                    conn.commit()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -762,13 +773,12 @@ class SessionManager:
         """請求書用スプレッドシートIDを取得"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT invoice_spreadsheet_id FROM users WHERE user_id = %s
-                ''', (user_id,))
-                result = cursor.fetchone()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT invoice_spreadsheet_id FROM users WHERE user_id = %s
+                    ''', (user_id,))
+                    result = cursor.fetchone()
             else:
                 conn = sqlite3.connect(self.db_path, check_same_thread=False)
                 cursor = conn.cursor()
@@ -789,16 +799,31 @@ class SessionManager:
         """ユーザーのセッションを完全にクリアする"""
         try:
             if self.use_postgres:
-                conn = psycopg2.connect(self.db_url)
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM sessions WHERE user_id = %s", (user_id,))
-                conn.commit()
-                conn.close()
+                with self._pg_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("DELETE FROM sessions WHERE user_id = %s", (user_id,))
+                    conn.commit()
             else:
                 with sqlite3.connect(self.db_path) as conn:
                     cursor = conn.cursor()
                     cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
                     conn.commit()
+            cache = self._get_request_cache()
+            if cache is not None:
+                cache.pop(user_id, None)
             logger.info(f"Session cleared for user: {user_id}")
         except Exception as e:
-            logger.error(f"Error clearing session for user {user_id}: {e}") 
\ No newline at end of file
+            logger.error(f"Error clearing session for user {user_id}: {e}")
+
+
+_shared_session_manager = None
+_shared_session_manager_lock = threading.Lock()
+
+def get_session_manager():
+    """プロセス内で共有するSessionManagerを取得（DB初期化と接続プールを1回で済ませる）"""
+    global _shared_session_manager
+    if _shared_session_manager is None:
+        with _shared_session_manager_lock:
+            if _shared_session_manager is None:
+                _shared_session_manager = SessionManager()
+    return _shared_session_manager